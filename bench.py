@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+###
+# Copyright (c) 2005,2009, James Vega
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""Benchmarks the plugin against the saved provider pages in fixtures/.
+
+Usage: python bench.py [options] [benchmark ...]
+
+With no benchmarks named, all of them are run.
+"""
+
+import os
+import sys
+import math
+import time
+import zlib
+import select
+import shutil
+import optparse
+import tempfile
+import multiprocessing
+
+here = os.path.dirname(os.path.abspath(__file__))
+fixtures = os.path.join(here, 'fixtures')
+
+# Like supybot-test, point the registry at a scratch directory before anything
+# imports supybot.conf, so running a benchmark doesn't touch a real bot.
+scratch = tempfile.mkdtemp(prefix='weather-bench-')
+registryFilename = os.path.join(scratch, 'bench.conf')
+fd = open(registryFilename, 'w')
+try:
+    for (name, value) in (('directories.data', 'data'),
+                          ('directories.conf', 'conf'),
+                          ('directories.log', 'logs'),
+                          ('log.stdout', 'False'),
+                          ('flush', 'False')):
+        fd.write('supybot.%s: %s\n' % (name, os.path.join(scratch, value)
+                                       if name.startswith('directories')
+                                       else value))
+finally:
+    fd.close()
+
+import supybot.registry as registry
+registry.open(registryFilename)
+import supybot.conf as conf
+
+sys.path.insert(0, here)
+import plugin
+import replay
+
+def pages():
+    """Returns (name, text) pairs for the saved pages, i.e. the files
+    fixtures/index.txt lists."""
+    L = []
+    for name in sorted(set(replay.Replay(fixtures).responses.values())):
+        fd = open(os.path.join(fixtures, name), 'rb')
+        try:
+            L.append((name, fd.read()))
+        finally:
+            fd.close()
+    return L
+
+def timed(f, *args):
+    """Returns the mean seconds per call of f(*args), running it for at least
+    a tenth of a second."""
+    n = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < 0.1:
+        for _ in xrange(100):
+            f(*args)
+        n += 100
+        elapsed = time.time() - start
+    return elapsed / n
+
+def clearCaches():
+    for cache in (plugin.Weather._pages, plugin.Weather._observations,
+                  plugin.Weather._unknown, plugin.Weather._locations,
+                  plugin.Weather.wunder._feeds):
+        cache.clear()
+
+def percentile(times, p):
+    """Returns the pth percentile of the sorted times, by nearest rank."""
+    return times[max(0, int(math.ceil(p / 100.0 * len(times))) - 1)]
+
+def encoding(options):
+    """Bytes on the wire and decode cost for gzip and deflate responses."""
+    print '%-30s %8s %8s %8s %6s %10s %10s' % \
+          ('page', 'identity', 'gzip', 'deflate', 'saved',
+           'gzip us', 'deflate us')
+    totals = [0, 0, 0]
+    for (name, text) in pages():
+        encoded = (replay.gzipped(text), zlib.compress(text))
+        for body in encoded:
+            assert plugin.decode(body, body is encoded[0] and 'gzip'
+                                 or 'deflate') == text
+        sizes = (len(text),) + tuple(map(len, encoded))
+        for (i, size) in enumerate(sizes):
+            totals[i] += size
+        costs = (timed(plugin.decode, encoded[0], 'gzip'),
+                 timed(plugin.decode, encoded[1], 'deflate'))
+        print '%-30s %8d %8d %8d %5.0f%% %10.1f %10.1f' % \
+              ((name,) + sizes + (100 - 100.0 * sizes[1] / sizes[0],
+                                  1e6 * costs[0], 1e6 * costs[1]))
+    print '%-30s %8d %8d %8d %5.0f%%' % \
+          (('total',) + tuple(totals) + (100 - 100.0 * totals[1] / totals[0],))
+
+def wunder(options):
+    """Parsing the wunder conditions table with and without BeautifulSoup."""
+    cb = plugin.Weather.wunder()
+    text = cb._formatSymbols(dict(pages())['wunder-mobile-columbus.html'])
+    assert cb._wunderTable(text) == cb._wunderSoup(text)
+    soup = timed(cb._wunderSoup, text)
+    table = timed(cb._wunderTable, text)
+    print '%-20s %10.1f us' % ('BeautifulSoup', 1e6 * soup)
+    print '%-20s %10.1f us' % ('table extractor', 1e6 * table)
+    print '%-20s %10.1fx' % ('speedup', soup / table)
+
+def ham(options):
+    """Finding the ham fields in one pass rather than one search each."""
+    cb = plugin.Weather
+    html = dict(pages())['ham-columbus.html']
+    regexps = [cb._hamMultiLoc, cb._hamLoc, cb._interregex, cb._hamTemp,
+               cb._hamCond, cb._hamChill, cb._hamHeat]
+    def searches():
+        return ('was not found' in html, 'Multiple Locations for' in html,
+                [r.search(html) for r in regexps])
+    fields = cb._hamScanner.scan(html)
+    for (name, r) in zip(('multiLoc', 'loc', 'interLoc', 'temp', 'cond',
+                          'chill', 'heat'), regexps):
+        m = r.search(html)
+        assert (m and m.group()) == (fields.get(name) and fields[name].group())
+    separate = timed(searches)
+    single = timed(cb._hamScanner.scan, html)
+    print '%-20s %10.1f us' % ('separate searches', 1e6 * separate)
+    print '%-20s %10.1f us' % ('single pass', 1e6 * single)
+    print '%-20s %10.1fx' % ('speedup', separate / single)
+
+def replayed(options):
+    """Uncached lookups answered from the recorded responses."""
+    import config
+    cb = plugin.Weather(None)
+    plugin.Weather._pool = replay.Replay()
+    # Nothing is sent to the providers, so there's no need to be polite.
+    conf.supybot.plugins.Weather.limits.rate.setValue(0)
+    def lookup(command, loc):
+        clearCaches()
+        cb._lookup(command, loc, None)
+    for command in cb.weatherCommands:
+        for loc in ('Columbus, OH', 'Paris'):
+            try:
+                lookup(command, loc)
+            except plugin.NoLocation:
+                continue
+            print '%-12s %-14s %10.1f us' % \
+                  (command, loc, 1e6 * timed(lookup, command, loc))
+
+def serve(queue, kwargs):
+    server = replay.Server(**kwargs)
+    queue.put(server.server_address)
+    server.serve_forever()
+
+def commands(options):
+    """Replies to each command from a stand-in serving the recorded pages."""
+    import config
+    import supybot.irclib as irclib
+    import supybot.ircmsgs as ircmsgs
+    import supybot.registry as registry
+    import supybot.plugin as plugins
+    class Irc(irclib.Irc):
+        """Lets us wait for replies without polling for them."""
+        def __init__(self, network):
+            (self.readable, self.writable) = os.pipe()
+            irclib.Irc.__init__(self, network)
+
+        def queueMsg(self, msg):
+            irclib.Irc.queueMsg(self, msg)
+            os.write(self.writable, '.')
+
+        def waitMsg(self, timeout):
+            deadline = time.time() + timeout
+            msg = self.takeMsg()
+            while msg is None:
+                remaining = deadline - time.time()
+                if remaining <= 0 or \
+                   not select.select([self.readable], [], [], remaining)[0]:
+                    return None
+                os.read(self.readable, 512)
+                msg = self.takeMsg()
+            return msg
+    latencies = {}
+    for s in options.hostLatencies:
+        (host, ms) = s.split('=', 1)
+        latencies[host] = float(ms) / 1000
+    # The stand-in runs in its own process, so its CPU time isn't counted.
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(queue, {
+        'latency': options.latency / 1000, 'latencies': latencies,
+        'failures': options.failures, 'mode': options.failureMode,
+        'compress': options.gzip, 'seed': options.seed}))
+    server.daemon = True
+    server.start()
+    try:
+        address = queue.get(True, 10)
+        conf.supybot.protocols.http.proxy.setValue('%s:%s' % address)
+        conf.supybot.protocols.irc.throttleTime.setValue(0)
+        conf.supybot.abuse.flood.command.setValue(False)
+        weather = conf.supybot.plugins.Weather
+        weather.limits.rate.setValue(0)
+        for setting in options.settings:
+            (name, value) = setting.split('=', 1)
+            try:
+                group = weather
+                for part in registry.split(name):
+                    group = group.get(part)
+                group.set(value)
+            except registry.RegistryException, e:
+                sys.exit('Can\'t set %s: %s' % (name, e))
+        plugin.Weather._pool = plugin.ConnectionPool()
+        clearCaches()
+        conf.registerNetwork('bench')
+        irc = Irc('bench')
+        while irc.takeMsg():
+            pass
+        plugins.loadPluginClass(irc, plugins.loadPluginModule('Owner'))
+        irc.addCallback(plugin.Class(irc))
+        print '%-12s %8s %8s %8s %8s %8s %10s %12s' % \
+              ('command', 'replies', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+               'replies/s', 'cpu ms/reply')
+        for command in options.commands or \
+                       ('weather',) + plugin.Weather.weatherCommands:
+            times = []
+            errors = 0
+            cpu = sum(os.times()[:2])
+            start = time.time()
+            for i in xrange(options.requests):
+                if options.cold:
+                    clearCaches()
+                loc = options.locations[i % len(options.locations)]
+                sent = time.time()
+                irc.feedMsg(ircmsgs.privmsg(irc.nick, '%s %s' % (command, loc),
+                                            prefix='bench!bench@localhost'))
+                msg = irc.waitMsg(options.timeout)
+                times.append(time.time() - sent)
+                if msg is None or msg.args[1].startswith('Error:'):
+                    errors += 1
+            elapsed = time.time() - start
+            cpu = sum(os.times()[:2]) - cpu
+            times.sort()
+            print '%-12s %8d %8d %8.1f %8.1f %8.1f %10.1f %12.2f' % \
+                  (command, len(times), errors, 1000 * percentile(times, 50),
+                   1000 * percentile(times, 95), 1000 * percentile(times, 99),
+                   len(times) / elapsed, 1000 * cpu / len(times))
+    finally:
+        server.terminate()
+
+benchmarks = [('encoding', encoding), ('wunder', wunder), ('ham', ham),
+              ('replay', replayed), ('commands', commands)]
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]',
+                                   description=__doc__.splitlines()[0])
+    group = optparse.OptionGroup(parser, 'commands benchmark')
+    group.add_option('-n', '--requests', type='int', default=50,
+                     help='requests to send each command [%default]')
+    group.add_option('--command', action='append', dest='commands',
+                     default=[], metavar='COMMAND',
+                     help='command to send; may be repeated [all of them]')
+    group.add_option('--location', action='append', dest='locations',
+                     default=[], metavar='LOCATION',
+                     help='location to ask for, in turn with any others '
+                          '[Columbus, OH and Paris]')
+    group.add_option('--latency', type='float', default=0, metavar='MS',
+                     help='milliseconds the stand-in waits before each '
+                          'response [%default]')
+    group.add_option('--host-latency', action='append', dest='hostLatencies',
+                     default=[], metavar='HOST=MS',
+                     help='latency for a single provider host')
+    group.add_option('--failures', type='float', default=0,
+                     metavar='FRACTION',
+                     help='fraction of requests that fail [%default]')
+    group.add_option('--failure-mode', dest='failureMode', metavar='MODE',
+                     choices=replay.Server.modes, default='error',
+                     help='how requests fail: error (a 503) or reset '
+                          '[%default]')
+    group.add_option('--gzip', action='store_true', default=False,
+                     help='gzip responses')
+    group.add_option('--cold', action='store_true', default=False,
+                     help="empty the plugin's caches before each request")
+    group.add_option('--set', action='append', dest='settings', default=[],
+                     metavar='NAME=VALUE',
+                     help='set supybot.plugins.Weather.NAME to VALUE, e.g. '
+                          'fallback.hedge=True; may be repeated')
+    group.add_option('--seed', type='int', default=0,
+                     help='seed for choosing the failed requests [%default]')
+    group.add_option('--timeout', type='float', default=30,
+                     metavar='SECONDS',
+                     help='how long to wait for each reply [%default]')
+    parser.add_option_group(group)
+    (options, args) = parser.parse_args()
+    if not options.locations:
+        options.locations = ['Columbus, OH', 'Paris']
+    for s in options.hostLatencies + options.settings:
+        if '=' not in s:
+            parser.error('Expected NAME=VALUE, not %r.' % s)
+    names = [name for (name, _) in benchmarks]
+    for arg in args:
+        if arg not in names:
+            parser.error('Unknown benchmark %r; choose from %s.' %
+                         (arg, ', '.join(names)))
+    try:
+        for (name, f) in benchmarks:
+            if not args or name in args:
+                print '%s: %s' % (name, f.__doc__)
+                f(options)
+                print
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -53,6 +53,20 @@ class WeatherUnit(registry.String):
 class WeatherCommand(registry.OnlySomeStrings):
     validStrings = plugin.Weather.weatherCommands
 
+class NonNegativeFloat(registry.Float):
+    """Value must be a floating-point number greater than or equal to zero."""
+    def setValue(self, v):
+        if v < 0:
+            self.error()
+        else:
+            registry.Float.setValue(self, v)
+
+class Locations(registry.SeparatedListOf):
+    Value = registry.String
+    def splitter(self, s):
+        return [loc.strip() for loc in s.split('|') if loc.strip()]
+    joiner = ' | '.join
+
 Weather = conf.registerPlugin('Weather')
 conf.registerChannelValue(Weather, 'temperatureUnit',
     WeatherUnit('Fahrenheit', """Sets the default temperature unit to use when
@@ -66,6 +80,156 @@ conf.registerChannelValue(Weather, 'convert',
     automatically convert weather units to the unit specified in
     supybot.plugins.Weather.temperatureUnit."""))
 
+conf.registerGroup(Weather, 'fallback')
+conf.registerGlobalValue(Weather.fallback, 'hedge',
+    registry.Boolean(False, """Determines whether the weather command tries
+    its other weather commands concurrently instead of one after another when
+    supybot.plugins.Weather.command is slow or fails.  The first reply found
+    is used."""))
+conf.registerGlobalValue(Weather.fallback, 'hedgeDelay',
+    NonNegativeFloat(1.0, """Determines how many seconds the weather command
+    waits on supybot.plugins.Weather.command before also trying the other
+    weather commands when supybot.plugins.Weather.fallback.hedge is on.  0
+    tries them all at once."""))
+conf.registerGlobalValue(Weather.fallback, 'adaptive',
+    registry.Boolean(False, """Determines whether the weather command orders
+    the weather commands it falls back to by their recent success rate and
+    speed rather than trying them in a fixed order."""))
+conf.registerGlobalValue(Weather.fallback, 'healthy',
+    registry.Probability(0.5, """Determines the fraction of recent lookups
+    supybot.plugins.Weather.command must have succeeded in to still be tried
+    first when supybot.plugins.Weather.fallback.adaptive is on."""))
+
+conf.registerGroup(Weather, 'batch')
+conf.registerGlobalValue(Weather.batch, 'workers',
+    registry.PositiveInteger(4, """Determines how many locations the batch
+    command looks up at once."""))
+conf.registerGlobalValue(Weather.batch, 'maximum',
+    registry.PositiveInteger(10, """Determines how many locations can be
+    given to the batch command at once."""))
+
+conf.registerGroup(Weather, 'broadcast')
+conf.registerChannelValue(Weather.broadcast, 'locations',
+    Locations([], """Determines the locations whose weather is sent to the
+    channel every supybot.plugins.Weather.broadcast.interval minutes,
+    separated by |."""))
+conf.registerGlobalValue(Weather.broadcast, 'interval',
+    registry.PositiveInteger(30, """Determines how many minutes apart the
+    weather is sent to the channels subscribed to it with
+    supybot.plugins.Weather.broadcast.locations.  Each location is looked up
+    once for all the channels subscribed to it.  Changes take effect when the
+    plugin is reloaded."""))
+
+conf.registerGroup(Weather, 'breaker')
+conf.registerGlobalValue(Weather.breaker, 'threshold',
+    registry.NonNegativeInteger(5, """Determines how many fetches in a row a
+    weather command must fail before it is skipped without trying the network.
+    0 disables skipping failing commands."""))
+conf.registerGlobalValue(Weather.breaker, 'cooldown',
+    registry.PositiveInteger(60, """Determines how many seconds a failing
+    weather command is skipped for before a single fetch is allowed through
+    to check whether it has recovered."""))
+
+conf.registerGroup(Weather, 'limits')
+conf.registerGlobalValue(Weather.limits, 'rate',
+    NonNegativeFloat(2.0, """Determines how many requests per second, on
+    average, the weather commands may make to a single provider host.  0
+    disables the limit."""))
+conf.registerGlobalValue(Weather.limits, 'burst',
+    registry.PositiveInteger(5, """Determines how many requests the weather
+    commands may make to a single provider host in a burst before
+    supybot.plugins.Weather.limits.rate applies."""))
+conf.registerGlobalValue(Weather.limits, 'concurrency',
+    registry.NonNegativeInteger(4, """Determines how many requests to a
+    single provider host may be in progress at once.  0 disables the
+    limit."""))
+conf.registerGlobalValue(Weather.limits, 'wait',
+    registry.PositiveFloat(5.0, """Determines how many seconds a request
+    waits for its turn under supybot.plugins.Weather.limits before giving
+    up."""))
+conf.registerGlobalValue(Weather.limits, 'stale',
+    registry.NonNegativeInteger(600, """Determines how many seconds past its
+    cache TTL a page may still be served when a new request for it has to give
+    up waiting for its turn."""))
+
+conf.registerGroup(Weather, 'connections')
+conf.registerGlobalValue(Weather.connections, 'perHost',
+    registry.NonNegativeInteger(2, """Determines how many idle connections to
+    each provider host are kept open for later requests to reuse.  0 closes
+    each connection after its request."""))
+conf.registerGlobalValue(Weather.connections, 'timeout',
+    registry.PositiveFloat(10.0, """Determines how many seconds the weather
+    commands wait on a provider's connection before giving up."""))
+conf.registerGlobalValue(Weather.connections, 'budget',
+    registry.NonNegativeInteger(65536, """Determines how many bytes of a page
+    the ham and wunder rss commands read while looking for the parts of it
+    they use.  The rest of the page is skipped once everything has been found
+    or this many bytes have been read.  0 always reads whole pages."""))
+
+conf.registerGroup(Weather, 'timings')
+conf.registerGlobalValue(Weather.timings, 'log',
+    registry.Boolean(False, """Determines whether the time each weather
+    command spent fetching pages, parsing them, converting their readings and
+    replying is logged after every reply."""))
+
+conf.registerGroup(Weather, 'metrics')
+conf.registerGlobalValue(Weather.metrics, 'file',
+    registry.String('', """Determines the file in the data directory the
+    weather commands' counters and timings are written to, in the Prometheus
+    text format, every supybot.plugins.Weather.metrics.interval seconds.  If
+    empty, they aren't written."""))
+conf.registerGlobalValue(Weather.metrics, 'interval',
+    registry.PositiveInteger(60, """Determines how many seconds apart the
+    metrics are written to supybot.plugins.Weather.metrics.file.  Changes take
+    effect when the plugin is reloaded."""))
+conf.registerGlobalValue(Weather.metrics, 'port',
+    registry.NonNegativeInteger(0, """Determines the port on localhost the
+    weather commands' counters and timings are served on, in the Prometheus
+    text format.  0 doesn't serve them.  Changes take effect when the plugin
+    is reloaded."""))
+
+conf.registerGroup(Weather, 'profile')
+conf.registerGlobalValue(Weather.profile, 'sample',
+    registry.Probability(0.0, """Determines the fraction of weather commands
+    that are run under cProfile, with their stats dumped to
+    supybot.plugins.Weather.profile.directory, named for the command and
+    location.  0 profiles none of them."""))
+conf.registerGlobalValue(Weather.profile, 'directory',
+    registry.String('WeatherProfiles', """Determines the directory in the
+    data directory that profiles of the weather commands are dumped to."""))
+conf.registerGlobalValue(Weather.profile, 'keep',
+    registry.PositiveInteger(50, """Determines how many of the newest
+    profiles are kept in supybot.plugins.Weather.profile.directory; older
+    ones are removed."""))
+
+conf.registerGroup(Weather, 'cache')
+conf.registerGlobalValue(Weather.cache, 'size',
+    registry.PositiveInteger(256, """Determines the maximum number of
+    fetched pages kept in memory.  When the cache is full, the least recently
+    used page is dropped."""))
+conf.registerGlobalValue(Weather.cache, 'persist',
+    registry.Boolean(False, """Determines whether cached observations and
+    location lookups are also kept in a file in the data directory, so they
+    survive restarts and reloads of the bot."""))
+conf.registerGlobalValue(Weather.cache, 'locationTtl',
+    registry.NonNegativeInteger(7 * 24 * 60 * 60, """Determines how many
+    seconds a location's lookup (e.g. the city search done by the cnn command)
+    is reused before it is looked up again.  0 disables caching of
+    lookups."""))
+conf.registerGlobalValue(Weather.cache, 'negativeTtl',
+    registry.NonNegativeInteger(120, """Determines how many seconds a
+    location that a command couldn't find keeps failing without being looked
+    up again.  0 disables remembering unknown locations."""))
+conf.registerGroup(Weather.cache, 'ttl')
+# Forecasts (wunder rss) change less often than current conditions.
+cacheTtls = {'wunder': 300, 'wunder rss': 900, 'cnn': 300, 'ham': 300}
+for command in plugin.Weather.weatherCommands:
+    ttl = cacheTtls[command]
+    conf.registerGlobalValue(Weather.cache.ttl, plugin.registryName(command),
+        registry.NonNegativeInteger(ttl, """Determines how many seconds a page
+        fetched by the %s command is reused before it is fetched again.  0
+        disables caching for that command.""" % command))
+
 conf.registerUserValue(conf.users.plugins.Weather, 'lastLocation',
     registry.String('', ''))
 
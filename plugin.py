@@ -27,17 +27,37 @@
 # POSSIBILITY OF SUCH DAMAGE.
 ###
 
+import os
 import re
+import time
+import errno
+import Queue
+import anydbm
+import socket
+import cPickle
+import httplib
+import urlparse
+import threading
+import zlib
+import bisect
+import random
+import cProfile
+import BaseHTTPServer
 
 # Specifically use our local copy since later versions changed their interface
 # and (depending on the version) don't work as well
 from local import BeautifulSoup
 
+import supybot.log as log
 import supybot.conf as conf
 import supybot.utils as utils
+import supybot.world as world
 from supybot.commands import *
+import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
+import supybot.schedule as schedule
 import supybot.callbacks as callbacks
+from supybot.utils.structures import RingBuffer
 
 try:
     feedparser = utils.python.universalImport('feedparser', 'local.feedparser')
@@ -75,19 +95,1495 @@ noLocationError = 'No such location could be found.'
 class NoLocation(callbacks.Error):
     pass
 
+class ProviderUnavailable(utils.web.Error):
+    pass
+
+class Throttled(ProviderUnavailable):
+    pass
+
+class HostLimiter(object):
+    """Limits the rate and the concurrency of requests to a single host.
+
+    The rate is enforced with a token bucket holding up to burst requests and
+    refilled at rate requests per second.  A rate or concurrency of 0 means no
+    limit, as does a negative rate.
+    """
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.tokens = None
+        self.updated = time.time()
+        self.active = 0
+
+    def acquire(self, rate, burst, concurrency, timeout):
+        """Waits up to timeout seconds for a request to be allowed and
+        returns whether it was.  Allowed requests must call release()."""
+        deadline = time.time() + timeout
+        rate = max(rate, 0)
+        self.cond.acquire()
+        try:
+            while True:
+                now = time.time()
+                if self.tokens is None:
+                    self.tokens = float(burst)
+                else:
+                    elapsed = now - self.updated
+                    self.tokens = min(float(burst),
+                                      self.tokens + elapsed * rate)
+                self.updated = now
+                free = not concurrency or self.active < concurrency
+                if free and (not rate or self.tokens >= 1):
+                    if rate:
+                        self.tokens -= 1
+                    self.active += 1
+                    return True
+                wait = deadline - now
+                if wait <= 0:
+                    return False
+                if free:
+                    # Only waiting on the bucket, so we know when to look
+                    # again.
+                    wait = min(wait, (1 - self.tokens) / rate)
+                self.cond.wait(wait)
+        finally:
+            self.cond.release()
+
+    def release(self):
+        self.cond.acquire()
+        try:
+            self.active -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+class CircuitBreaker(object):
+    """Stops a provider from being used after it fails repeatedly.
+
+    After threshold consecutive failures the breaker opens and refuses calls
+    for cooldown seconds.  It then lets a single probe through: if the probe
+    succeeds the breaker closes again, otherwise it reopens.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.openedAt = None
+        self.probing = False
+
+    def allow(self, cooldown):
+        """Returns whether a call may be made now; if this call is the
+        probe, it must be followed by succeeded() or failed()."""
+        self.lock.acquire()
+        try:
+            if self.openedAt is None:
+                return True
+            if self.probing or time.time() - self.openedAt < cooldown:
+                return False
+            self.probing = True
+            return True
+        finally:
+            self.lock.release()
+
+    def succeeded(self):
+        self.lock.acquire()
+        try:
+            self.failures = 0
+            self.openedAt = None
+            self.probing = False
+        finally:
+            self.lock.release()
+
+    def cancel(self):
+        """Withdraws the probe allow() let through, if this call was it,
+        without it counting as a success or a failure."""
+        self.lock.acquire()
+        try:
+            self.probing = False
+        finally:
+            self.lock.release()
+
+    def failed(self, threshold):
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            if self.probing or (threshold and self.failures >= threshold):
+                self.openedAt = time.time()
+            self.probing = False
+        finally:
+            self.lock.release()
+
+class ExpiringCache(object):
+    """A thread-safe mapping whose entries expire after their own ttl.
+
+    At most size entries are kept; when the cache is full, expired entries are
+    dropped first and then the least recently used one is evicted.  Expired
+    entries are kept for grace more seconds, during which get() returns them
+    only when asked for stale values.
+    """
+    def __init__(self, size=256, grace=0):
+        self.size = size
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.clock = 0
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None, stale=False):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            now = time.time()
+            if entry[0] + self.grace <= now:
+                del self.entries[key]
+                return default
+            if entry[0] <= now and not stale:
+                return default
+            self.clock += 1
+            entry[1] = self.clock
+            return entry[2]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, ttl):
+        self.lock.acquire()
+        try:
+            self.clock += 1
+            self.entries[key] = [time.time() + ttl, self.clock, value]
+            if len(self.entries) > self.size:
+                self._evict()
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def _evict(self):
+        now = time.time()
+        for (key, entry) in self.entries.items():
+            if entry[0] <= now:
+                del self.entries[key]
+        while len(self.entries) > self.size:
+            # A linear scan is fine here; we only get here after a fetch, and
+            # that costs far more than walking a few hundred entries.
+            (used, key) = min([(e[1], k) for (k, e) in self.entries.items()])
+            del self.entries[key]
+
+class DiskCache(object):
+    """A dbm file holding cached values so they survive restarts.
+
+    Keys are tuples of strings.  Values are stored with their absolute expiry
+    time, and writes are done by a background thread so commands never wait
+    on the disk.  That thread also sweeps out expired entries when the file
+    is opened and every sweepInterval seconds after, so entries that are
+    never asked for again don't pile up.
+    """
+    sweepInterval = 60 * 60
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = anydbm.open(filename, 'c')
+        self.writes = Queue.Queue()
+        self.writer = threading.Thread(target=self._write,
+                                       name='Weather cache writer')
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+    def get(self, key):
+        """Returns a (value, ttl) pair for key, or (None, 0) if it isn't
+        stored or has expired."""
+        key = '\x00'.join(key)
+        self.lock.acquire()
+        try:
+            try:
+                (expires, value) = cPickle.loads(self.db[key])
+            except KeyError:
+                return (None, 0)
+            except Exception:
+                # A half-written or otherwise unreadable entry; drop it.
+                del self.db[key]
+                return (None, 0)
+            ttl = expires - time.time()
+            if ttl <= 0:
+                del self.db[key]
+                return (None, 0)
+            return (value, ttl)
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, ttl):
+        self.writes.put(('\x00'.join(key), time.time() + ttl, value))
+
+    def close(self):
+        self.writes.put(None)
+        self.writer.join()
+        self.lock.acquire()
+        try:
+            self.db.close()
+        finally:
+            self.lock.release()
+
+    def sweep(self):
+        """Deletes the entries that have expired or can't be read."""
+        self.lock.acquire()
+        try:
+            keys = self.db.keys()
+        finally:
+            self.lock.release()
+        # Each entry is checked under its own hold of the lock, so lookups
+        # made meanwhile only ever wait on a single entry.
+        for key in keys:
+            self.lock.acquire()
+            try:
+                try:
+                    (expires, _) = cPickle.loads(self.db[key])
+                except KeyError:
+                    continue
+                except Exception:
+                    expires = 0
+                if expires <= time.time():
+                    del self.db[key]
+            finally:
+                self.lock.release()
+
+    def _write(self):
+        self.sweep()
+        swept = time.time()
+        while True:
+            item = self.writes.get()
+            if item is None:
+                return
+            (key, expires, value) = item
+            data = cPickle.dumps((expires, value), cPickle.HIGHEST_PROTOCOL)
+            self.lock.acquire()
+            try:
+                self.db[key] = data
+            finally:
+                self.lock.release()
+            if time.time() - swept >= self.sweepInterval:
+                self.sweep()
+                swept = time.time()
+
+class SingleFlight(object):
+    """Coalesces concurrent calls made with the same key.
+
+    The first caller for a key makes the call; callers arriving while it's
+    still running wait for it and get the same result (or exception).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, f, *args):
+        self.lock.acquire()
+        try:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = [threading.Event(), None, None]
+                self.calls[key] = call
+        finally:
+            self.lock.release()
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            try:
+                call[1] = f(*args)
+            except Exception, e:
+                call[2] = e
+                raise
+        finally:
+            self.lock.acquire()
+            try:
+                del self.calls[key]
+            finally:
+                self.lock.release()
+            call[0].set()
+        return call[1]
+
+class ProviderHealth(object):
+    """Keeps the outcome and duration of each command's recent lookups."""
+    def __init__(self, window=50):
+        self.lock = threading.Lock()
+        self.window = window
+        self.samples = {}
+
+    def record(self, command, ok, seconds):
+        self.lock.acquire()
+        try:
+            if command not in self.samples:
+                self.samples[command] = RingBuffer(self.window)
+            self.samples[command].append((ok, seconds))
+        finally:
+            self.lock.release()
+
+    def measure(self, command, f, *args):
+        """Returns f(*args), recording how long it took and whether the
+        provider failed.  Not finding the location is an answer like any
+        other, so only utils.web.Error counts as a failure."""
+        started = time.time()
+        try:
+            value = f(*args)
+        except NoLocation:
+            self.record(command, True, time.time() - started)
+            raise
+        except utils.web.Error:
+            self.record(command, False, time.time() - started)
+            raise
+        self.record(command, True, time.time() - started)
+        return value
+
+    def _samples(self, command):
+        self.lock.acquire()
+        try:
+            return list(self.samples.get(command, ()))
+        finally:
+            self.lock.release()
+
+    def successRate(self, command):
+        """Returns the fraction of command's recent lookups that succeeded,
+        or 1.0 if it hasn't been used yet."""
+        samples = self._samples(command)
+        if not samples:
+            return 1.0
+        return float(len([ok for (ok, _) in samples if ok])) / len(samples)
+
+    def latency(self, command):
+        """Returns the mean duration of command's recent lookups."""
+        samples = self._samples(command)
+        if not samples:
+            return 0.0
+        return sum([seconds for (_, seconds) in samples]) / len(samples)
+
+    def cost(self, command, penalty=0):
+        """Returns the expected time, in seconds, command takes to find a
+        location, counting the retries its failures would cost.
+
+        Each failure is charged at least penalty seconds, since a provider
+        that fails quickly (an unknown host, a refused connection, an open
+        circuit breaker) is no more use than one that times out.
+        """
+        samples = self._samples(command)
+        if not samples:
+            return 0.0
+        seconds = 0.0
+        for (ok, duration) in samples:
+            if not ok:
+                duration = max(duration, penalty)
+            seconds += duration
+        seconds /= len(samples)
+        return seconds / max(self.successRate(command), 0.01)
+
+class ProviderStats(object):
+    """Counts the lookups each weather command is asked for and how they
+    end, along with the weather command's fallbacks to it and the bytes of
+    the pages it fetched.
+
+    The latencies of the window most recent lookups are kept for
+    percentiles; the mean covers every lookup since the last reset.
+    """
+    counters = ('requests', 'success', 'noLocation', 'webError', 'fallbacks',
+                'bytes')
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.counts = {}
+            self.seconds = {}
+            self.latencies = {}
+        finally:
+            self.lock.release()
+
+    def count(self, command, counter, n=1):
+        self.lock.acquire()
+        try:
+            key = (command, counter)
+            self.counts[key] = self.counts.get(key, 0) + n
+        finally:
+            self.lock.release()
+
+    def measure(self, command, f, *args):
+        """Returns f(*args), counting it as a lookup by command."""
+        started = time.time()
+        outcome = None
+        try:
+            value = f(*args)
+            outcome = 'success'
+            return value
+        except NoLocation:
+            outcome = 'noLocation'
+            raise
+        except utils.web.Error:
+            outcome = 'webError'
+            raise
+        finally:
+            seconds = time.time() - started
+            self.lock.acquire()
+            try:
+                for counter in ('requests', outcome):
+                    if counter is not None:
+                        key = (command, counter)
+                        self.counts[key] = self.counts.get(key, 0) + 1
+                self.seconds[command] = self.seconds.get(command, 0) + seconds
+                if command not in self.latencies:
+                    self.latencies[command] = RingBuffer(self.window)
+                self.latencies[command].append(seconds)
+            finally:
+                self.lock.release()
+
+    def get(self, command):
+        """Returns a dict of command's counters, with its mean and 95th
+        percentile latency in seconds under 'mean' and 'p95'."""
+        self.lock.acquire()
+        try:
+            d = dict([(counter, self.counts.get((command, counter), 0))
+                      for counter in self.counters])
+            latencies = list(self.latencies.get(command, ()))
+            seconds = self.seconds.get(command, 0.0)
+        finally:
+            self.lock.release()
+        d['mean'] = d['p95'] = 0.0
+        if latencies:
+            latencies.sort()
+            d['mean'] = seconds / d['requests']
+            d['p95'] = latencies[int(0.95 * (len(latencies) - 1))]
+        return d
+
+class Timing(object):
+    """How long each stage of replying to a single command took: fetching
+    pages, parsing them, converting the readings and sending the reply.
+
+    Stages time only their own work, so a page fetched while parsing
+    counts towards fetch but not parse.  Time in none of them (e.g. waiting
+    on another thread's lookup) is only counted in total.
+    """
+    stages = ('fetch', 'parse', 'convert', 'reply')
+    def __init__(self, command, location):
+        self.command = command
+        self.location = location
+        self.ok = None
+        self.started = time.time()
+        self.total = None
+        self.seconds = dict.fromkeys(self.stages, 0.0)
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        self.lock.acquire()
+        try:
+            self.seconds[stage] += seconds
+        finally:
+            self.lock.release()
+
+class Timings(object):
+    """Times the stages of the command each thread is running.
+
+    Each finished Timing is handed to every one of sinks, which may be any
+    callable taking one.
+    """
+    def __init__(self, sinks=()):
+        self.local = threading.local()
+        self.sinks = list(sinks)
+
+    def start(self, command, location):
+        timing = Timing(command, location)
+        self.join(timing)
+        return timing
+
+    def join(self, timing):
+        """Makes the stages timed in this thread count towards timing, e.g.
+        for lookups started on another thread's behalf."""
+        self.local.timing = timing
+        self.local.inner = 0
+
+    def current(self):
+        """Returns the Timing this thread's stages count towards, if any."""
+        return getattr(self.local, 'timing', None)
+
+    def finish(self, timing, ok):
+        timing.ok = ok
+        timing.total = time.time() - timing.started
+        if self.current() is timing:
+            self.local.timing = None
+        for sink in self.sinks:
+            try:
+                sink(timing)
+            except Exception:
+                log.exception('Uncaught exception in timing sink %r.', sink)
+
+    def time(self, stage, f, *args):
+        """Returns f(*args), counting the time it took towards stage."""
+        timing = self.current()
+        if timing is None:
+            return f(*args)
+        inner = self.local.inner
+        self.local.inner = 0
+        started = time.time()
+        try:
+            return f(*args)
+        finally:
+            seconds = time.time() - started
+            timing.add(stage, seconds - self.local.inner)
+            self.local.inner = inner + seconds
+
+def logTiming(timing):
+    """Logs timing as a line of name=value pairs if
+    supybot.plugins.Weather.timings.log is on."""
+    if not conf.supybot.plugins.Weather.timings.log():
+        return
+    stages = ' '.join(['%s=%.3f' % (stage, timing.seconds[stage])
+                       for stage in timing.stages])
+    log.info('Weather timing: command=%s location=%s ok=%s %s total=%.3f',
+             utils.str.dqrepr(timing.command),
+             utils.str.dqrepr(timing.location), timing.ok, stages,
+             timing.total)
+
+class Histograms(object):
+    """Counts how long each stage of each command took into buckets of
+    increasing size; 'total' is counted alongside the stages."""
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def __call__(self, timing):
+        seconds = timing.seconds.items()
+        seconds.append(('total', timing.total))
+        self.lock.acquire()
+        try:
+            for (stage, n) in seconds:
+                key = (timing.command, stage)
+                if key not in self.histograms:
+                    self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+                histogram = self.histograms[key]
+                histogram[0][bisect.bisect_left(self.buckets, n)] += 1
+                histogram[1] += n
+        finally:
+            self.lock.release()
+
+    def items(self):
+        """Returns the (command, stage) of each histogram kept so far, sorted,
+        with its counts and seconds as get returns them."""
+        self.lock.acquire()
+        try:
+            return [(key, list(counts), seconds) for (key, (counts, seconds))
+                    in sorted(self.histograms.items())]
+        finally:
+            self.lock.release()
+
+    def get(self, command, stage):
+        """Returns the counts in each bucket, the last one for times beyond
+        all of them, and the seconds in all for command's stage."""
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get((command, stage))
+            if histogram is None:
+                return ([0] * (len(self.buckets) + 1), 0.0)
+            return (list(histogram[0]), histogram[1])
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.histograms.clear()
+        finally:
+            self.lock.release()
+
+def exposition(commands, stats, histograms):
+    """Returns the ProviderStats of each of commands and the Histograms of
+    their timings in the Prometheus text exposition format."""
+    def labels(**kwargs):
+        L = []
+        for (name, value) in sorted(kwargs.items()):
+            value = str(value).replace('\\', r'\\').replace('"', r'\"')
+            L.append('%s="%s"' % (name, value.replace('\n', r'\n')))
+        return '{%s}' % ','.join(L)
+    def family(name, kind, help):
+        name = 'supybot_weather_' + name
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        return name
+    lines = []
+    counts = [(command, stats.get(command)) for command in commands]
+    name = family('requests_total', 'counter',
+                  'Requests each weather command has had.')
+    for (command, d) in counts:
+        lines.append('%s%s %s' % (name, labels(command=command),
+                                  d['requests']))
+    name = family('results_total', 'counter',
+                  'Requests each weather command has had, by how they ended.')
+    for (command, d) in counts:
+        for (result, counter) in (('found', 'success'),
+                                  ('not_found', 'noLocation'),
+                                  ('web_error', 'webError')):
+            lines.append('%s%s %s' % (name, labels(command=command,
+                                                   result=result),
+                                      d[counter]))
+    name = family('fallbacks_total', 'counter',
+                  'Times the weather command fell back to each command.')
+    for (command, d) in counts:
+        lines.append('%s%s %s' % (name, labels(command=command),
+                                  d['fallbacks']))
+    name = family('fetched_bytes_total', 'counter',
+                  'Bytes of pages fetched by each weather command.')
+    for (command, d) in counts:
+        lines.append('%s%s %s' % (name, labels(command=command), d['bytes']))
+    name = family('seconds', 'histogram',
+                  'Seconds each stage of replying to a command took.')
+    for ((command, stage), counts, seconds) in histograms.items():
+        total = 0
+        bounds = [repr(float(b)) for b in histograms.buckets] + ['+Inf']
+        for (bound, n) in zip(bounds, counts):
+            total += n
+            lines.append('%s_bucket%s %s' %
+                         (name, labels(command=command, stage=stage,
+                                       le=bound), total))
+        lines.append('%s_sum%s %r' % (name, labels(command=command,
+                                                    stage=stage), seconds))
+        lines.append('%s_count%s %s' % (name, labels(command=command,
+                                                      stage=stage), total))
+    lines.append('')
+    return '\n'.join(lines)
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        text = self.server.exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        log.debug('Weather metrics: ' + format, *args)
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    """Serves what exposition() returns to scrapers on a localhost port, from
+    a thread of its own."""
+    def __init__(self, port, exposition):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           MetricsHandler)
+        self.exposition = exposition
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever,
+                             name='Weather metrics server')
+        t.setDaemon(True)
+        t.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def dumpProfile(profile, directory, tags, keep):
+    """Dumps profile's stats to a file in directory named for when it was
+    dumped and tags, then removes all but the keep newest such files."""
+    now = time.time()
+    name = [time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) +
+            '.%06d' % (now % 1 * 1000000)]
+    name.extend([re.sub(r'[^\w.-]+', '_', tag)[:40] for tag in tags])
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    profile.dump_stats(os.path.join(directory, '-'.join(name) + '.pstats'))
+    filenames = [filename for filename in os.listdir(directory)
+                 if filename.endswith('.pstats')]
+    # The names start with when they were dumped, so they sort oldest first.
+    filenames.sort()
+    for filename in filenames[:-keep]:
+        try:
+            os.remove(os.path.join(directory, filename))
+        except OSError:
+            pass # Another thread got to it first.
+
+class ConnectionPool(object):
+    """Fetches pages over persistent HTTP connections, keeping up to size
+    idle connections per host so later requests can skip connecting.
+
+    Like utils.web.getUrl, it follows redirects, honors utils.web.proxy and
+    raises utils.web.Error on failure.  Responses may be gzip or deflate
+    compressed on the wire; callers always see the decoded text.
+
+    Callers that only need part of a page can name the regexps they're
+    looking for; the page is then read a chunk at a time and the connection
+    dropped as soon as they've all matched or budget bytes have been read.
+    """
+    maxIdle = 30 # Servers drop idle keep-alive connections quite quickly.
+    maxRedirects = 5
+    chunkSize = 4096
+    def __init__(self, size=2):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def getUrl(self, url, headers=None, timeout=None, fields=(), budget=0):
+        return self.request(url, headers, timeout, fields, budget)[2]
+
+    def request(self, url, headers=None, timeout=None, fields=(), budget=0):
+        """Returns a (status, headers, text) triple for url.  The response's
+        header names are lowercased.
+
+        If fields and budget are given, text may be only as much of the page
+        as it took for every regexp in fields to match.
+        """
+        if headers is None:
+            headers = utils.web.defaultHeaders
+        if not budget:
+            fields = ()
+        for _ in range(self.maxRedirects + 1):
+            (status, reason, responseHeaders, text) = self._get(url, headers,
+                                                                timeout,
+                                                                fields, budget)
+            location = responseHeaders.get('location')
+            if status in (301, 302, 303, 307) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            if status >= 400:
+                if status == 403:
+                    raise utils.web.Error, utils.web.FORBIDDEN
+                raise utils.web.Error, 'HTTP Error %s: %s' % (status, reason)
+            return (status, responseHeaders, text)
+        raise utils.web.Error, 'Too many redirects.'
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for connections in self.idle.values():
+                for (conn, _) in connections:
+                    conn.close()
+            self.idle.clear()
+        finally:
+            self.lock.release()
+
+    def _get(self, url, headers, timeout, fields=(), budget=0):
+        (scheme, host, path, query, _) = urlparse.urlsplit(url)
+        target = urlparse.urlunsplit(('', '', path or '/', query, ''))
+        proxy = force(utils.web.proxy)
+        if proxy:
+            # Proxies want the whole URL and connect to the host themselves.
+            (scheme, host, target) = ('http', proxy, url)
+        key = (scheme, host)
+        headers = dict(headers)
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        # A connection the server has since closed can't be told apart from a
+        # live one until we use it, so requests on reused connections get a
+        # second chance on a fresh one.
+        for reused in (True, False):
+            conn = reused and self._take(key) or None
+            if reused and conn is None:
+                continue
+            if reused and conn.sock is not None:
+                # The connection was made for an earlier request's timeout.
+                conn.timeout = timeout
+                conn.sock.settimeout(timeout)
+            if conn is None:
+                conn = self._connect(scheme, host, timeout)
+            try:
+                conn.request('GET', target, headers=headers)
+                response = conn.getresponse()
+                scanner = None
+                if fields and response.status == 200:
+                    scanner = Scanner(fields, budget)
+                (text, complete) = self._read(response, scanner)
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if reused and self._dropped(e):
+                    continue
+                if isinstance(e, socket.timeout):
+                    raise utils.web.Error, utils.web.TIMED_OUT
+                if isinstance(e, socket.error):
+                    raise utils.web.Error, utils.web.strError(e)
+                raise utils.web.Error, str(e)
+            except utils.web.Error:
+                conn.close()
+                raise
+            if response.will_close or not complete:
+                conn.close()
+            else:
+                self._give(key, conn)
+            return (response.status, response.reason,
+                    dict(response.getheaders()), text)
+
+    def _read(self, response, scanner):
+        """Returns response's decoded body and whether it was read to the
+        end."""
+        decoder = Decoder(response.getheader('content-encoding'))
+        if scanner is None:
+            return (decoder.decode(response.read()) + decoder.flush(), True)
+        while True:
+            data = response.read(self.chunkSize)
+            if not data:
+                scanner.feed(decoder.flush())
+                return (scanner.text, True)
+            if scanner.feed(decoder.decode(data)):
+                # The rest of a small page may have arrived with this chunk.
+                complete = response.isclosed() or response.length == 0
+                return (scanner.text, complete)
+
+    def _dropped(e):
+        """Returns whether e means the server had closed the connection, as
+        opposed to the request itself failing or timing out."""
+        if isinstance(e, httplib.BadStatusLine):
+            return True
+        if isinstance(e, socket.timeout) or not isinstance(e, socket.error):
+            return False
+        return e.args[0] in (errno.ECONNRESET, errno.EPIPE)
+    _dropped = staticmethod(_dropped)
+
+    def _connect(self, scheme, host, timeout):
+        if scheme == 'https':
+            cls = httplib.HTTPSConnection
+        elif scheme == 'http':
+            cls = httplib.HTTPConnection
+        else:
+            raise utils.web.Error, 'Unsupported URL scheme: %s' % scheme
+        try:
+            return cls(host, timeout=timeout)
+        except httplib.InvalidURL, e:
+            raise utils.web.Error, 'Invalid URL: %s' % e
+
+    def _take(self, key):
+        self.lock.acquire()
+        try:
+            connections = self.idle.get(key, [])
+            while connections:
+                (conn, since) = connections.pop()
+                if time.time() - since < self.maxIdle:
+                    return conn
+                conn.close()
+            return None
+        finally:
+            self.lock.release()
+
+    def _give(self, key, conn):
+        self.lock.acquire()
+        try:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.size:
+                connections.append((conn, time.time()))
+                conn = None
+        finally:
+            self.lock.release()
+        if conn is not None:
+            conn.close()
+
+class Decoder(object):
+    """Undoes an HTTP Content-Encoding, which may be None, 'identity', 'gzip'
+    or 'deflate', on a body given a piece at a time."""
+    def __init__(self, encoding):
+        self.encoding = (encoding or 'identity').strip().lower()
+        if self.encoding in ('gzip', 'x-gzip'):
+            self.zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.zlib = zlib.decompressobj()
+        elif self.encoding == 'identity':
+            self.zlib = None
+        else:
+            raise utils.web.Error, \
+                  'Unsupported Content-Encoding: %s' % self.encoding
+        self.started = False
+
+    def decode(self, data):
+        if self.zlib is None or not data:
+            return data
+        try:
+            try:
+                text = self.zlib.decompress(data)
+            except zlib.error:
+                if self.started or self.encoding != 'deflate':
+                    raise
+                # RFC 2616 says zlib format, but some servers send raw deflate.
+                self.zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+                text = self.zlib.decompress(data)
+            self.started = True
+            return text
+        except zlib.error, e:
+            raise utils.web.Error, \
+                  'Undecodable %s response: %s' % (self.encoding, e)
+
+    def flush(self):
+        if self.zlib is None:
+            return ''
+        return self.zlib.flush()
+
+def decode(text, encoding):
+    """Returns text undone from its HTTP Content-Encoding."""
+    decoder = Decoder(encoding)
+    return decoder.decode(text) + decoder.flush()
+
+class Scanner(object):
+    """Collects a page as it arrives, looking for the given regexps in it.
+    feed returns True once they have all matched or the page has reached
+    budget bytes, since the rest of the page isn't needed then."""
+    def __init__(self, patterns, budget):
+        self.pending = list(patterns)
+        self.budget = budget
+        self.text = ''
+
+    def feed(self, data):
+        self.text += data
+        # Only whole lines are searched, so a match can't change as the rest
+        # of its line arrives.
+        end = self.text.rfind('\n') + 1
+        self.pending = [r for r in self.pending
+                        if r.search(self.text, 0, end) is None]
+        return not self.pending or len(self.text) >= self.budget
+
+class FieldScanner(object):
+    """Finds the first match of each of several regexps in a single pass
+    over a page, rather than searching the page once for each of them.
+
+    fields is a sequence of (name, regexp) pairs.  Each regexp must start
+    with some fixed text; the page is scanned once for all of those texts,
+    and a regexp is only tried where its text turns up.  A plain string may
+    be given instead of a regexp, and is looked for case-sensitively.
+    """
+    def __init__(self, fields):
+        self.fields = []
+        for (name, pattern) in fields:
+            if isinstance(pattern, basestring):
+                prefix = pattern
+            else:
+                prefix = self._prefix(pattern.pattern)
+            self.fields.append((name, prefix.lower(), pattern))
+        prefixes = sorted(set([p for (_, p, _) in self.fields]),
+                          key=len, reverse=True)
+        alternatives = '|'.join(map(re.escape, prefixes))
+        if self._overlap(prefixes):
+            # A match only begins after the previous one ends, so prefixes
+            # which can overlap need a lookahead to find them all.
+            alternatives = '(?=%s)' % alternatives
+        self.anchors = re.compile(alternatives)
+
+    def _prefix(pattern):
+        prefix = re.match(r'[^\\.^$*+?{}\[\]|()]*', pattern).group()
+        if pattern[len(prefix):len(prefix)+1] in ('*', '?', '{'):
+            prefix = prefix[:-1]
+        if not prefix:
+            raise ValueError, 'Regexp %r has no fixed prefix.' % pattern
+        return prefix
+    _prefix = staticmethod(_prefix)
+
+    def _overlap(prefixes):
+        for a in prefixes:
+            for b in prefixes:
+                for i in range(1, len(a)):
+                    if a[i:].startswith(b) or b.startswith(a[i:]):
+                        return True
+        return False
+    _overlap = staticmethod(_overlap)
+
+    def scan(self, text):
+        """Returns a dict mapping the names of the fields found in text to
+        their regexp's first match, or True for plain strings."""
+        found = {}
+        # Lowercasing once is much cheaper than an re.I scan.
+        lowered = text.lower()
+        for m in self.anchors.finditer(lowered):
+            i = m.start()
+            for (name, prefix, pattern) in self.fields:
+                if name in found or not lowered.startswith(prefix, i):
+                    continue
+                if isinstance(pattern, basestring):
+                    if text.startswith(pattern, i):
+                        found[name] = True
+                else:
+                    match = pattern.match(text, i)
+                    if match is not None:
+                        found[name] = match
+            if len(found) == len(self.fields):
+                break
+        return found
+
+def normalizeUrl(url):
+    """Returns url with the scheme and host lowercased and the fragment
+    removed, so equivalent URLs share a cache entry."""
+    (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url.strip())
+    return urlparse.urlunsplit((scheme.lower(), netloc.lower(), path or '/',
+                                query, ''))
+
+def normalizeLocation(loc):
+    """Returns loc lowercased with its whitespace collapsed."""
+    return ' '.join(loc.lower().split())
+
+def registryName(command):
+    """Returns the name of command's per-provider registry variables, e.g.
+    'wunderRss' for 'wunder rss'."""
+    words = command.split()
+    return words[0] + ''.join([w.capitalize() for w in words[1:]])
+
+def providerValue(group, command):
+    return group.get(registryName(command))()
+
 class Weather(callbacks.Plugin):
     weatherCommands = ('wunder', 'wunder rss', 'cnn', 'ham')
     threaded = True
+    _scheduler = None
+    def __init__(self, irc):
+        super(Weather, self).__init__(irc)
+        metrics = conf.supybot.plugins.Weather.metrics
+        broadcast = conf.supybot.plugins.Weather.broadcast
+        # The metrics and subscriptions are shared by every instance, so only
+        # the latest one schedules their events.
+        if Weather._scheduler is not None:
+            Weather._scheduler._unschedule()
+        schedule.addPeriodicEvent(self._writeMetrics, metrics.interval(),
+                                  'WeatherMetrics', now=False)
+        schedule.addPeriodicEvent(self._broadcast, broadcast.interval() * 60,
+                                  'WeatherBroadcast', now=False)
+        Weather._scheduler = self
+        self._metricsServer = None
+        if metrics.port():
+            try:
+                self._metricsServer = MetricsServer(metrics.port(),
+                                                    self._exposition)
+                self._metricsServer.start()
+            except socket.error, e:
+                self.log.error('Couldn\'t serve metrics on port %s: %s',
+                               metrics.port(), utils.web.strError(e))
+
     def callCommand(self, method, irc, msg, *args, **kwargs):
+        timing = None
+        command = ' '.join(method)
+        if len(method) > 1 and method[0] == self.canonicalName():
+            # Called as "weather wunder", say.
+            command = ' '.join(method[1:])
+        if command in ('weather', 'batch') or command in self.weatherCommands:
+            location = ' '.join(args[0])
+            timing = Weather._timings.start(command, location)
+        ok = False
+        try:
+            try:
+                f = super(Weather, self).callCommand
+                if timing is not None and \
+                   random.random() < self.registryValue('profile.sample'):
+                    self._profile((command, location), f, method, irc, msg,
+                                  *args, **kwargs)
+                else:
+                    f(method, irc, msg, *args, **kwargs)
+                ok = True
+            except utils.web.Error, e:
+                irc.error(str(e))
+        finally:
+            if timing is not None:
+                Weather._timings.finish(timing, ok)
+
+    def _profile(self, tags, f, *args, **kwargs):
+        """Runs f(*args, **kwargs) under cProfile and dumps the stats, tagged
+        with tags, to supybot.plugins.Weather.profile.directory.
+
+        Only this thread is profiled, so lookups the weather command hedges
+        with in other threads aren't included.
+        """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(f, *args, **kwargs)
+        finally:
+            directory = self.registryValue('profile.directory')
+            directory = conf.supybot.directories.data.dirize(directory)
+            try:
+                dumpProfile(profile, directory, tags,
+                            self.registryValue('profile.keep'))
+            except EnvironmentError, e:
+                self.log.warning('Couldn\'t dump profile to %s: %s',
+                                 directory, utils.web.strError(e))
+
+    def _unschedule(self):
+        for name in ('WeatherMetrics', 'WeatherBroadcast'):
+            try:
+                schedule.removePeriodicEvent(name)
+            except KeyError:
+                pass
+        Weather._scheduler = None
+
+    def die(self):
+        if Weather._scheduler is self:
+            self._unschedule()
+        if self._metricsServer is not None:
+            self._metricsServer.stop()
+        Weather._pool.close()
+        if Weather._disk is not None:
+            Weather._disk.close()
+            Weather._disk = None
+        super(Weather, self).die()
+
+    def _exposition(self):
+        return exposition(self.weatherCommands, Weather._stats,
+                          Weather._histograms)
+
+    def _writeMetrics(self):
+        """Writes the metrics to supybot.plugins.Weather.metrics.file, if
+        it's set."""
+        filename = conf.supybot.plugins.Weather.metrics.file()
+        if not filename:
+            return
+        filename = conf.supybot.directories.data.dirize(filename)
+        fd = utils.file.AtomicFile(filename, makeBackupIfSmaller=False)
         try:
-            super(Weather, self).callCommand(method, irc, msg, *args, **kwargs)
-        except utils.web.Error, e:
-            irc.error(str(e))
+            fd.write(self._exposition())
+        except EnvironmentError:
+            fd.rollback()
+            raise
+        fd.close()
 
     def _noLocation():
         raise NoLocation, noLocationError
     _noLocation = staticmethod(_noLocation)
 
+    _pages = ExpiringCache()
+    def _fetch(command, url, fields=()):
+        """Returns the page at url on behalf of the given weather command.
+
+        Pages are shared between all channels and kept for the command's
+        supybot.plugins.Weather.cache.ttl.  If fields are given, the page may
+        be cut short once they've all matched; see _request.
+        """
+        cache = conf.supybot.plugins.Weather.cache
+        ttl = providerValue(cache.ttl, command)
+        if not ttl:
+            return Weather._download(command, url, fields)
+        key = normalizeUrl(url)
+        text = Weather._pages.get(key)
+        if text is None:
+            try:
+                text = Weather._download(command, url, fields)
+            except Throttled:
+                text = Weather._pages.get(key, stale=True)
+                if text is None:
+                    raise
+                log.info('Serving a stale copy of %s; %s is busy.',
+                         url, utils.web.getDomain(url))
+                return text
+            Weather._pages.size = cache.size()
+            Weather._pages.grace = conf.supybot.plugins.Weather.limits.stale()
+            Weather._pages.set(key, text, ttl)
+        return text
+    _fetch = staticmethod(_fetch)
+
+    _breakers = dict([(c, CircuitBreaker()) for c in weatherCommands])
+    def _download(command, url, fields=()):
+        """Downloads url on behalf of the given weather command."""
+        return Weather._timings.time('fetch', Weather._request, command, url,
+                                     None, fields)[2]
+    _download = staticmethod(_download)
+
+    def _request(command, url, headers=None, fields=()):
+        """Requests url on behalf of the given weather command and returns
+        the response's (status, headers, text).
+
+        If fields are given, only as much of the page is read as it takes for
+        each of those regexps to match, up to connections.budget bytes.
+
+        Requests to each host are limited by supybot.plugins.Weather.limits;
+        Throttled is raised if one can't be made within limits.wait seconds.
+        ProviderUnavailable is raised without touching the network while the
+        command's circuit breaker is open.
+        """
+        # The breaker comes first, so a provider that's known to be down
+        # neither waits for nor uses up its host's requests.
+        breaker = Weather._breakers[command]
+        config = conf.supybot.plugins.Weather.breaker
+        threshold = config.threshold()
+        if threshold and not breaker.allow(config.cooldown()):
+            raise ProviderUnavailable, \
+                  format('%s is unavailable after failing %n in a row.',
+                         command, (breaker.failures, 'time'))
+        host = utils.web.getDomain(url).lower()
+        limiter = Weather._getLimiter(host)
+        limits = conf.supybot.plugins.Weather.limits
+        if not limiter.acquire(limits.rate(), limits.burst(),
+                               limits.concurrency(), limits.wait()):
+            breaker.cancel()
+            raise Throttled, format('Too many requests to %s are waiting.  '
+                                    'Try again later.', host)
+        try:
+            try:
+                connections = conf.supybot.plugins.Weather.connections
+                Weather._pool.size = connections.perHost()
+                response = Weather._pool.request(url, headers,
+                                                 connections.timeout(),
+                                                 fields, connections.budget())
+            except Exception:
+                breaker.failed(threshold)
+                raise
+            breaker.succeeded()
+            Weather._stats.count(command, 'bytes', len(response[2]))
+            return response
+        finally:
+            limiter.release()
+    _request = staticmethod(_request)
+
+    _pool = ConnectionPool()
+    _limiters = {}
+    _limitersLock = threading.Lock()
+    def _getLimiter(host):
+        Weather._limitersLock.acquire()
+        try:
+            if host not in Weather._limiters:
+                Weather._limiters[host] = HostLimiter()
+            return Weather._limiters[host]
+        finally:
+            Weather._limitersLock.release()
+    _getLimiter = staticmethod(_getLimiter)
+
+    _disk = None
+    _diskLock = threading.Lock()
+    def _getDisk():
+        """Returns the DiskCache backing the observation caches, opening it on
+        first use, or None if supybot.plugins.Weather.cache.persist is off."""
+        if not conf.supybot.plugins.Weather.cache.persist():
+            return None
+        Weather._diskLock.acquire()
+        try:
+            if Weather._disk is None:
+                filename = conf.supybot.directories.data.dirize('Weather.db')
+                Weather._disk = DiskCache(filename)
+            return Weather._disk
+        finally:
+            Weather._diskLock.release()
+    _getDisk = staticmethod(_getDisk)
+
+    _inFlight = SingleFlight()
+    def _cached(cache, name, key, ttl, lookup, *args):
+        """Returns the value cached for key, or calls lookup(*args) and caches
+        what it returns for ttl seconds.
+
+        If the disk cache is enabled, it is consulted on a miss and updated
+        after each lookup under the given name.  Concurrent misses for the same
+        key share a single lookup.
+        """
+        value = cache.get(key)
+        if value is not None:
+            return value
+        return Weather._inFlight.do((name,) + key, Weather._fill, cache, name,
+                                    key, ttl, lookup, *args)
+    _cached = staticmethod(_cached)
+
+    def _fill(cache, name, key, ttl, lookup, *args):
+        # Another thread may have filled the cache between our miss and
+        # getting our turn.
+        value = cache.get(key)
+        if value is not None:
+            return value
+        disk = Weather._getDisk()
+        if disk is not None:
+            (value, remaining) = disk.get((name,) + key)
+            if value is not None:
+                cache.set(key, value, remaining)
+                return value
+        value = lookup(*args)
+        cache.size = conf.supybot.plugins.Weather.cache.size()
+        cache.set(key, value, ttl)
+        if disk is not None:
+            disk.set((name,) + key, value, ttl)
+        return value
+    _fill = staticmethod(_fill)
+
+    _observations = ExpiringCache()
+    _unknown = ExpiringCache()
+    _health = ProviderHealth()
+    _histograms = Histograms()
+    _timings = Timings([logTiming, _histograms])
+    _stats = ProviderStats()
+    def _observe(command, loc, lookup):
+        """Returns the observation lookup(loc) makes for the given weather
+        command, reusing a cached one when possible.
+
+        Observations hold readings in the units the provider reported them in,
+        so a single entry serves channels with any temperatureUnit.  Locations
+        the command couldn't find are remembered for
+        supybot.plugins.Weather.cache.negativeTtl and fail straight away.
+        Every call is counted in the command's Weather._stats.
+        """
+        return Weather._stats.measure(command, Weather._cachedObservation,
+                                      command, loc, lookup)
+    _observe = staticmethod(_observe)
+
+    def _cachedObservation(command, loc, lookup):
+        cache = conf.supybot.plugins.Weather.cache
+        key = (command, normalizeLocation(loc))
+        if Weather._unknown.get(key):
+            Weather._noLocation()
+        def observe(loc):
+            return Weather._timings.time('parse', Weather._health.measure,
+                                         command, lookup, loc)
+        try:
+            ttl = providerValue(cache.ttl, command)
+            if not ttl:
+                return Weather._inFlight.do(('observation',) + key,
+                                            observe, loc)
+            return Weather._cached(Weather._observations, 'observation', key,
+                                   ttl, observe, loc)
+        except NoLocation:
+            if cache.negativeTtl():
+                Weather._unknown.size = cache.size()
+                Weather._unknown.set(key, True, cache.negativeTtl())
+            raise
+    _cachedObservation = staticmethod(_cachedObservation)
+
+    _locations = ExpiringCache()
+    def _resolve(command, query, lookup):
+        """Returns what lookup(query) resolves query to for the given command,
+        e.g. a station or search result, reusing a cached resolution when
+        possible.
+
+        Resolutions rarely change, so they're kept for
+        supybot.plugins.Weather.cache.locationTtl.
+        """
+        ttl = conf.supybot.plugins.Weather.cache.locationTtl()
+        if not ttl:
+            return lookup(query)
+        key = (command, normalizeLocation(query))
+        return Weather._cached(Weather._locations, 'location', key, ttl,
+                               lookup, query)
+    _resolve = staticmethod(_resolve)
+
+    _resolved = threading.local()
+    def _resolvedPage(command, url, text):
+        """Notes that the lookup resolving a location fetched text from url,
+        so the observation that follows on this thread needn't fetch it
+        again."""
+        Weather._resolved.page = (command, url, text)
+    _resolvedPage = staticmethod(_resolvedPage)
+
+    def _fetchResolved(command, url, fields=()):
+        """Returns the page at url like Weather._fetch, reusing the one the
+        location's resolution just fetched if there was one."""
+        page = getattr(Weather._resolved, 'page', None)
+        Weather._resolved.page = None
+        if page is not None and page[:2] == (command, url):
+            return page[2]
+        return Weather._fetch(command, url, fields)
+    _fetchResolved = staticmethod(_fetchResolved)
+
+    def _getProvider(self, command):
+        """Returns the (observation, format) methods behind the given weather
+        command."""
+        return {'ham': (self._hamObservation, self._hamFormat),
+                'cnn': (self._cnnObservation, self._cnnFormat),
+                'wunder': (self.wunder._wunderObservation,
+                           self.wunder._wunderFormat),
+                'wunder rss': (self.wunder._rssObservation,
+                               self.wunder._rssFormat),
+                }[command]
+
+    def _getSummary(self, command):
+        """Returns the method giving the short summaries of the given weather
+        command's observations that batch replies with, or None if it has no
+        current conditions to summarize."""
+        return {'ham': self._hamSummary,
+                'cnn': self._cnnSummary,
+                'wunder': self.wunder._wunderSummary,
+                'wunder rss': None,
+                }[command]
+
+    def _lookup(self, command, loc, channel):
+        """Returns the given weather command's reply for loc in channel
+        without replying to anyone.
+
+        Raises NoLocation if the command has nothing to say about loc.
+        """
+        (observation, formatter) = self._getProvider(command)
+        obs = self._observe(command, loc, observation)
+        s = Weather._timings.time('convert', formatter, obs, channel)
+        if not s:
+            self._noLocation()
+        return s
+
+    def _fallbackOrder(self, preferred):
+        """Returns the weather commands in the order weather() should try
+        them, starting with preferred.
+
+        With supybot.plugins.Weather.fallback.adaptive on, the other commands
+        are ordered by how long their recent lookups took to succeed, and
+        preferred keeps its place only while its success rate is at least
+        supybot.plugins.Weather.fallback.healthy.  Each failure is charged at
+        least supybot.plugins.Weather.connections.timeout seconds.
+        """
+        commands = [preferred]
+        commands.extend([c for c in self.weatherCommands if c != preferred])
+        if not self.registryValue('fallback.adaptive'):
+            return commands
+        health = Weather._health
+        # A failure costs a caller the time it takes to give up on a request.
+        penalty = self.registryValue('connections.timeout')
+        def cost(command):
+            return health.cost(command, penalty)
+        if health.successRate(preferred) >= \
+           self.registryValue('fallback.healthy'):
+            others = commands[1:]
+            others.sort(key=cost)
+            return [preferred] + others
+        commands.sort(key=cost)
+        return commands
+
+    def _hedgedLookup(self, commands, loc, channel):
+        """Returns the first reply any of commands gives for loc, or None if
+        none of them can find it.
+
+        The first command is tried straight away.  The rest are started
+        together once it fails or once
+        supybot.plugins.Weather.fallback.hedgeDelay seconds have passed,
+        whichever comes first.  Replies arriving after the first good one are
+        discarded.
+        """
+        results = Queue.Queue()
+        timing = Weather._timings.current()
+        def run(command):
+            if timing is not None:
+                Weather._timings.join(timing)
+            try:
+                results.put((command, self._lookup(command, loc, channel)))
+            except (NoLocation, utils.web.Error), e:
+                self.log.info('%s lookup failed: %s', command, e)
+                results.put((command, None))
+            except Exception, e:
+                self.log.exception('Uncaught exception in %s lookup.', command)
+                results.put((command, None))
+        def start(command):
+            if command != commands[0]:
+                Weather._stats.count(command, 'fallbacks')
+            t = threading.Thread(target=run, args=(command,),
+                                 name='Weather %s lookup' % command)
+            t.setDaemon(True)
+            t.start()
+        waiting = list(commands)
+        delay = self.registryValue('fallback.hedgeDelay')
+        start(waiting.pop(0))
+        running = 1
+        while waiting or running:
+            if waiting and delay > 0:
+                try:
+                    (command, s) = results.get(True, delay)
+                except Queue.Empty:
+                    self.log.info('%s lookup is slow, also trying %s.',
+                                  commands[0], ', '.join(waiting))
+                    while waiting:
+                        start(waiting.pop(0))
+                        running += 1
+                    continue
+            else:
+                while waiting:
+                    start(waiting.pop(0))
+                    running += 1
+                (command, s) = results.get()
+            running -= 1
+            if s:
+                self.log.info('%s lookup succeeded.', command)
+                return s
+            delay = 0
+        return None
+
     def weather(self, irc, msg, args, location):
         """<US zip code | US/Canada city, state | Foreign city, country>
 
@@ -103,27 +1599,250 @@ class Weather(callbacks.Plugin):
         self.setUserValue('lastLocation', msg.prefix,
                           location, ignoreNoUser=True)
         args = [location]
-        commandName = self.registryValue('command', channel)
-        firstCommand = commandName
-        command = self.getCommandMethod(commandName.split())
+        commands = self._fallbackOrder(self.registryValue('command', channel))
+        if self.registryValue('fallback.hedge'):
+            s = self._hedgedLookup(commands, location, msg.args[0])
+            if s:
+                Weather._timings.time('reply', irc.reply, s)
+            else:
+                irc.error(format('Could not retrieve weather for %q.',
+                                 location))
+            return
+        firstCommand = commands[0]
+        command = self.getCommandMethod(firstCommand.split())
         try:
             command(irc, msg, args[:])
         except (NoLocation, utils.web.Error):
             self.log.info('%s lookup failed, Trying others.', firstCommand)
-            for commandName in self.weatherCommands:
-                if commandName != firstCommand:
-                    self.log.info('Trying %s.', commandName)
-                    try:
-                        command = self.getCommandMethod(commandName.split())
-                        command(irc, msg, args[:])
-                        self.log.info('%s lookup succeeded.', commandName)
-                        return
-                    except NoLocation:
-                        self.log.info('%s lookup failed as backup.',
-                                      commandName)
+            for commandName in commands[1:]:
+                self.log.info('Trying %s.', commandName)
+                Weather._stats.count(commandName, 'fallbacks')
+                try:
+                    command = self.getCommandMethod(commandName.split())
+                    command(irc, msg, args[:])
+                    self.log.info('%s lookup succeeded.', commandName)
+                    return
+                except (NoLocation, ProviderUnavailable):
+                    self.log.info('%s lookup failed as backup.', commandName)
             irc.error(format('Could not retrieve weather for %q.', location))
     weather = wrap(weather, [additional('text')])
 
+    def stats(self, irc, msg, args, optlist):
+        """[--reset]
+
+        Returns how many requests each weather command has had and how they
+        ended, how often the weather command fell back to it, how long its
+        requests took and how many bytes of pages it fetched.  If --reset is
+        given, the counts are started over afterwards.
+        """
+        L = []
+        for command in self.weatherCommands:
+            d = Weather._stats.get(command)
+            L.append(format('%s: %n, %i found, %i not found, %n, %n, '
+                            '%.1fms mean, %.1fms p95, %.1fKB', command,
+                            (d['requests'], 'request'), d['success'],
+                            d['noLocation'], (d['webError'], 'web error'),
+                            (d['fallbacks'], 'fallback'), 1000 * d['mean'],
+                            1000 * d['p95'], d['bytes'] / 1024.0))
+        if ('reset', True) in optlist:
+            Weather._stats.reset()
+        irc.reply('; '.join(L))
+    stats = wrap(stats, ['admin', getopts({'reset': ''})])
+
+    def _map(self, f, items):
+        """Returns [f(item) for item in items], running f on up to
+        supybot.plugins.Weather.batch.workers items at once.
+
+        Items are taken in order; where f raises, None is returned.  Repeated
+        lookups, e.g. of the same station, are shared through the caches.
+        """
+        waiting = Queue.Queue()
+        for (i, item) in enumerate(items):
+            waiting.put((i, item))
+        results = [None] * len(items)
+        timing = Weather._timings.current()
+        def work():
+            if timing is not None:
+                Weather._timings.join(timing)
+            while True:
+                try:
+                    (i, item) = waiting.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[i] = f(item)
+                except Exception:
+                    self.log.exception('Uncaught exception in lookup of %s.',
+                                       item)
+        threads = []
+        for _ in range(min(self.registryValue('batch.workers'), len(items))):
+            t = threading.Thread(target=work, name='Weather lookup')
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return results
+
+    def _summarize(self, commands, loc, channel):
+        """Returns a short summary of the current conditions at loc from the
+        first of commands that can find it, or None if none of them can."""
+        for command in commands:
+            if command != commands[0]:
+                Weather._stats.count(command, 'fallbacks')
+            (observation, _) = self._getProvider(command)
+            try:
+                obs = self._observe(command, loc, observation)
+                s = Weather._timings.time('convert',
+                                          self._getSummary(command),
+                                          obs, channel)
+            except (NoLocation, utils.web.Error), e:
+                self.log.info('%s lookup of %s failed: %s', command, loc, e)
+                continue
+            if s:
+                s = utils.web.htmlToText(s)
+                return s.decode('latin1').encode('utf-8')
+        return None
+
+    def batch(self, irc, msg, args, text):
+        """<location> [| <location> ...]
+
+        Returns the temperature and conditions in each of the given
+        locations, looking them up at the same time.  The locations are tried
+        with each weather command in turn, as the weather command would, but
+        wunder rss is skipped since it only has forecasts.
+        """
+        locations = []
+        seen = set()
+        for loc in text.split('|'):
+            loc = loc.strip()
+            if loc and normalizeLocation(loc) not in seen:
+                seen.add(normalizeLocation(loc))
+                locations.append(loc)
+        if not locations:
+            raise callbacks.ArgumentError
+        maximum = self.registryValue('batch.maximum')
+        if len(locations) > maximum:
+            irc.error(format('At most %n can be looked up at once.',
+                             (maximum, 'location')), Raise=True)
+        channel = None
+        if irc.isChannel(msg.args[0]):
+            channel = msg.args[0]
+        commands = self._fallbackOrder(self.registryValue('command', channel))
+        commands = [c for c in commands if self._getSummary(c) is not None]
+        def summarize(loc):
+            return self._summarize(commands, loc, msg.args[0])
+        results = self._map(summarize, locations)
+        L = [format('%s: %s', loc, s or 'not found')
+             for (loc, s) in zip(locations, results)]
+        Weather._timings.time('reply', irc.reply, '; '.join(L))
+    batch = wrap(batch, ['text'])
+
+    def _broadcast(self):
+        """Starts sending the weather for each of the locations in
+        supybot.plugins.Weather.broadcast.locations to the channels that
+        have them."""
+        subscribers = {}
+        locations = []
+        for irc in world.ircs:
+            for channel in irc.state.channels:
+                for loc in self.registryValue('broadcast.locations', channel):
+                    key = normalizeLocation(loc)
+                    if key not in subscribers:
+                        subscribers[key] = []
+                        locations.append(loc)
+                    subscribers[key].append((irc, channel))
+        if locations:
+            # Lookups can take a while, so they mustn't hold up the
+            # scheduler.
+            t = threading.Thread(target=self._sendBroadcasts,
+                                 args=(locations, subscribers),
+                                 name='Weather broadcast')
+            t.setDaemon(True)
+            t.start()
+
+    def _sendBroadcasts(self, locations, subscribers):
+        """Looks up each of locations once, with the weather commands in the
+        order the weather command tries them for
+        supybot.plugins.Weather.command, and sends the reply in each
+        subscribed channel's temperatureUnit to it."""
+        commands = self._fallbackOrder(self.registryValue('command'))
+        def send(loc):
+            channels = subscribers[normalizeLocation(loc)]
+            for command in commands:
+                (observation, formatter) = self._getProvider(command)
+                try:
+                    obs = self._observe(command, loc, observation)
+                except (NoLocation, utils.web.Error), e:
+                    self.log.info('%s lookup of %s failed: %s',
+                                  command, loc, e)
+                    continue
+                replies = [(irc, channel, formatter(obs, channel))
+                           for (irc, channel) in channels]
+                if [s for (_, _, s) in replies if s]:
+                    for (irc, channel, s) in replies:
+                        for line in self._wrap(irc, channel, s):
+                            irc.queueMsg(ircmsgs.privmsg(channel, line))
+                    return
+            self.log.info('Couldn\'t find the weather for %s to send to %L.',
+                          loc, [channel for (_, channel) in channels])
+        self._map(send, locations)
+
+    def _wrap(self, irc, channel, s):
+        """Splits s into lines short enough to be sent to channel whole, as
+        replies are split into mores."""
+        if not s:
+            return []
+        length = conf.get(conf.supybot.reply.mores.length, channel)
+        if not length:
+            length = 450 - len(irc.prefix) - len(channel)
+        return ircutils.wrap(s, length)
+
+    def subscribe(self, irc, msg, args, channel, loc):
+        """[<channel>] <location>
+
+        Sends the weather for <location> to <channel> every
+        supybot.plugins.Weather.broadcast.interval minutes.  <channel> is
+        only necessary if the message isn't sent in the channel itself.
+        """
+        locations = self.registryValue('broadcast.locations', channel)
+        keys = map(normalizeLocation, locations)
+        if normalizeLocation(loc) not in keys:
+            locations = locations + [loc]
+            self.setRegistryValue('broadcast.locations', locations, channel)
+        irc.replySuccess()
+    subscribe = wrap(subscribe, ['op', 'text'])
+
+    def unsubscribe(self, irc, msg, args, channel, loc):
+        """[<channel>] <location>
+
+        Stops sending the weather for <location> to <channel>.  <channel> is
+        only necessary if the message isn't sent in the channel itself.
+        """
+        locations = self.registryValue('broadcast.locations', channel)
+        key = normalizeLocation(loc)
+        remaining = [l for l in locations if normalizeLocation(l) != key]
+        if len(remaining) == len(locations):
+            irc.error(format('%s isn\'t subscribed to %q.', channel, loc),
+                      Raise=True)
+        self.setRegistryValue('broadcast.locations', remaining, channel)
+        irc.replySuccess()
+    unsubscribe = wrap(unsubscribe, ['op', 'text'])
+
+    def subscriptions(self, irc, msg, args, channel):
+        """[<channel>]
+
+        Returns the locations whose weather is sent to <channel>.  <channel>
+        is only necessary if the message isn't sent in the channel itself.
+        """
+        locations = self.registryValue('broadcast.locations', channel)
+        if not locations:
+            irc.reply(format('%s isn\'t subscribed to any locations.',
+                             channel))
+        else:
+            irc.reply(format('%L', map(utils.str.quoted, locations)))
+    subscriptions = wrap(subscriptions, ['channel'])
+
     def _toCelsius(temp, unit):
         if unit == 'K':
             return temp - 273.15
@@ -174,75 +1893,106 @@ class Weather(callbacks.Plugin):
     _hamMultiLoc = re.compile(
         r'Select from one of[^<]+</b></font></td></tr>\s*<tr><td><font[^>]+>'
         r'\s*<a href="(/cgi-bin/hw3[^"]+)">', re.I | re.S)
-    def ham(self, irc, msg, args, loc):
-        """<US zip code | US/Canada city, state | Foreign city, country>
-
-        Returns the approximate weather conditions for a given city.
-        """
+    _hamScanner = FieldScanner((('notFound', 'was not found'),
+                                ('multiple', 'Multiple Locations for'),
+                                ('multiLoc', _hamMultiLoc),
+                                ('loc', _hamLoc), ('interLoc', _interregex),
+                                ('temp', _hamTemp), ('cond', _hamCond),
+                                ('chill', _hamChill), ('heat', _hamHeat)))
+    # Everything _hamObservation reads from a page is near its top.
+    _hamFields = (re.compile(r'<span class="Place">[^<]*</span>', re.I),
+                  re.compile(r'class="Wx">[^<]*</td>', re.I),
+                  re.compile(r'class="Temp">[^<]*</td>', re.I),
+                  re.compile(r'Wind Chill:</td>\s+<td[^>]*>[^<]*</td>', re.I),
+                  re.compile(r'Heat Index:</td>\s+<td[^>]*>[^<]*</td>', re.I))
+    def _hamObservation(self, loc):
         url = 'http://www.hamweather.net/cgi-bin/hw3/hw3.cgi?' \
               'config=&forecast=zandh&pands=%s&Submit=GO' % \
               utils.web.urlquote(loc.lower())
-        html = utils.web.getUrl(url)
-        if 'was not found' in html:
+        html = self._fetch('ham', url, self._hamFields)
+        fields = self._hamScanner.scan(html)
+        if 'notFound' in fields:
             self._noLocation()
 
         # ham seems to automatically return a location for duplicate names with
         # no list of other possibilities anymore, so this code may not be
         # needed
-        if 'Multiple Locations for' in html:
-            m = self._hamMultiLoc.search(html)
+        if 'multiple' in fields:
+            m = fields.get('multiLoc')
             if m:
                 url = 'http://www.hamweather.net/%s' % m.group(1)
-                html = utils.web.getUrl(url)
+                html = self._fetch('ham', url, self._hamFields)
+                fields = self._hamScanner.scan(html)
             else:
                 self._noLocation()
-        headData = self._hamLoc.search(html)
-        if headData is not None:
-            (city, state, country) = headData.groups()
+        if 'loc' in fields:
+            (city, state, country) = fields['loc'].groups()
+        elif 'interLoc' in fields:
+            (city, state) = fields['interLoc'].groups()
         else:
-            headData = self._interregex.search(html)
-            if headData:
-                (city, state) = headData.groups()
-            else:
-                self._noLocation()
-        city = utils.web.htmlToText(city.strip())
-        state = utils.web.htmlToText(state.strip())
-        temp = self._hamTemp.search(html)
+            self._noLocation()
+        obs = {'city': utils.web.htmlToText(city.strip()),
+               'state': utils.web.htmlToText(state.strip()),
+               'temp': None, 'conds': None, 'chill': None, 'heat': None}
+        if 'temp' in fields:
+            (temp, deg, unit) = fields['temp'].groups()
+            obs['temp'] = (float(temp), utils.web.htmlToText(deg), unit)
+        if 'cond' in fields:
+            obs['conds'] = fields['cond'].group(1)
+        for name in ('chill', 'heat'):
+            m = fields.get(name)
+            if m is not None:
+                tempsplit = self._temp.search(utils.web.htmlToText(m.group(1)))
+                if tempsplit:
+                    (index, deg, unit) = tempsplit.groups()
+                    obs[name] = (float(index), deg, unit)
+        return obs
+
+    def _hamFormat(self, obs, channel):
+        temp = obs['temp']
         if temp is not None:
-            (temp, deg, unit) = temp.groups()
-            deg = utils.web.htmlToText(deg)
-            temp = self._getTemp(float(temp), deg, unit, msg.args[0])
-        conds = self._hamCond.search(html)
-        if conds is not None:
-            conds = conds.group(1)
+            temp = self._getTemp(temp[0], temp[1], temp[2], channel)
         index = ''
-        chill = self._hamChill.search(html)
+        chill = obs['chill']
         if chill is not None:
-            chill = chill.group(1)
-            chill = utils.web.htmlToText(chill)
-            tempsplit = self._temp.search(chill)
-            if tempsplit:
-                (chill, deg, unit) = tempsplit.groups()
-                chill = self._getTemp(float(chill), deg, unit,msg.args[0])
+            chill = self._getTemp(chill[0], chill[1], chill[2], channel)
             if float(chill[:-2]) < float(temp[:-2]):
                 index = format(' (Wind Chill: %s)', chill)
-        heat = self._hamHeat.search(html)
+        heat = obs['heat']
         if heat is not None:
-            heat = heat.group(1)
-            heat = utils.web.htmlToText(heat)
-            tempsplit = self._temp.search(heat)
-            if tempsplit:
-                (heat, deg, unit) = tempsplit.groups()
-                heat= self._getTemp(float(heat), deg, unit,msg.args[0])
+            heat = self._getTemp(heat[0], heat[1], heat[2], channel)
             if float(heat[:-2]) > float(temp[:-2]):
                 index = format(' (Heat Index: %s)', heat)
-        if temp and conds and city and state:
-            conds = conds.replace('Tsra', 'Thunderstorms')
-            conds = conds.replace('Ts', 'Thunderstorms')
+        conds = obs['conds']
+        if temp and conds and obs['city'] and obs['state']:
+            conds = self._hamConditions(conds)
             s = format('The current temperature in %s, %s is %s%s. '
                        'Conditions: %s.',
-                       city, state, temp, index, conds)
-            irc.reply(s.decode('latin1').encode('utf-8'))
+                       obs['city'], obs['state'], temp, index, conds)
+            return s.decode('latin1').encode('utf-8')
+        return None
+
+    def _hamConditions(conds):
+        conds = conds.replace('Tsra', 'Thunderstorms')
+        return conds.replace('Ts', 'Thunderstorms')
+    _hamConditions = staticmethod(_hamConditions)
+
+    def _hamSummary(self, obs, channel):
+        if not (obs['temp'] and obs['conds']):
+            return None
+        (temp, deg, unit) = obs['temp']
+        return format('%s, %s', self._getTemp(temp, deg, unit, channel),
+                      self._hamConditions(obs['conds']))
+
+    def ham(self, irc, msg, args, loc):
+        """<US zip code | US/Canada city, state | Foreign city, country>
+
+        Returns the approximate weather conditions for a given city.
+        """
+        obs = self._observe('ham', loc, self._hamObservation)
+        s = self._timings.time('convert', self._hamFormat, obs, msg.args[0])
+        if s:
+            self._timings.time('reply', irc.reply, s)
         else:
             irc.errorPossibleBug('The format of the page was odd.')
     ham = wrap(ham, ['text'])
@@ -261,11 +2011,16 @@ class Weather(callbacks.Plugin):
     # Certain countries are expected to use a standard abbreviation
     # The weather we pull uses weird codes.  Map obvious ones here.
     _cnnCountryMap = {'uk': 'en', 'de': 'ge'}
-    def cnn(self, irc, msg, args, loc):
-        """<US zip code | US/Canada city, state | Foreign city, country>
+    def _cnnSearch(self, loc):
+        url = self._cnnSearchUrl % (utils.web.urlquote(loc))
+        json = simplejson.loads(self._fetch('cnn', url))
+        if not json:
+            self._noLocation()
+        json = json[0]
+        return dict([(k, json[k])
+                     for k in ('locCode', 'zip', 'city', 'stateOrCountry')])
 
-        Returns the approximate weather conditions for a given city.
-        """
+    def _cnnObservation(self, loc):
         if ' ' in loc:
             #If we received more than 1 argument, then we got a city with a
             #multi-word name.  ie ['Garden', 'City', 'KS'] instead of
@@ -280,32 +2035,55 @@ class Weather(callbacks.Plugin):
         else:
             #We received a single argument.  Zipcode or station id.
             loc = loc.replace(',', '')
-        url = self._cnnSearchUrl % (utils.web.urlquote(loc))
-        json = simplejson.loads(utils.web.getUrl(url))
-        if not json:
-            self._noLocation()
-        json = json[0]
+        json = self._resolve('cnn', loc, self._cnnSearch)
         url = self._cnnUrl % (json['locCode'], json['zip'])
-        text = utils.web.getUrl(url)
-        location = ', '.join([json['city'], json['stateOrCountry']])
+        text = self._fetch('cnn', url)
+        obs = {'location': ', '.join([json['city'], json['stateOrCountry']]),
+               'temp': None, 'conds': None, 'humidity': None, 'wind': None}
         temp = self._cnnFTemp.search(text)
-        conds = self._cnnCond.search(text)
-        humidity = self._cnnHumid.search(text)
-        wind = self._cnnWind.search(text)
-        if location and temp:
+        if temp is not None:
             (temp, deg) = temp.groups()
-            unit = 'F'
-            temp = self._getTemp(float(temp), deg, unit, msg.args[0])
-            resp = [format('The current temperature in %s is %s.',
-                           location, temp)]
-            if conds is not None:
-                resp.append(format('Conditions: %s.', conds.group(1)))
-            if humidity is not None:
-                resp.append(format('Humidity: %s.', humidity.group(1)))
-            if wind is not None:
-                resp.append(format('Wind: %s.', wind.group(1)))
-            resp = map(utils.web.htmlToText, resp)
-            irc.reply(' '.join(resp))
+            obs['temp'] = (float(temp), deg, 'F')
+        for (name, r) in (('conds', self._cnnCond),
+                          ('humidity', self._cnnHumid),
+                          ('wind', self._cnnWind)):
+            m = r.search(text)
+            if m is not None:
+                obs[name] = m.group(1)
+        return obs
+
+    def _cnnFormat(self, obs, channel):
+        if not (obs['location'] and obs['temp']):
+            return None
+        (temp, deg, unit) = obs['temp']
+        temp = self._getTemp(temp, deg, unit, channel)
+        resp = [format('The current temperature in %s is %s.',
+                       obs['location'], temp)]
+        if obs['conds'] is not None:
+            resp.append(format('Conditions: %s.', obs['conds']))
+        if obs['humidity'] is not None:
+            resp.append(format('Humidity: %s.', obs['humidity']))
+        if obs['wind'] is not None:
+            resp.append(format('Wind: %s.', obs['wind']))
+        resp = map(utils.web.htmlToText, resp)
+        return ' '.join(resp)
+
+    def _cnnSummary(self, obs, channel):
+        if not (obs['temp'] and obs['conds']):
+            return None
+        (temp, deg, unit) = obs['temp']
+        return format('%s, %s', self._getTemp(temp, deg, unit, channel),
+                      obs['conds'])
+
+    def cnn(self, irc, msg, args, loc):
+        """<US zip code | US/Canada city, state | Foreign city, country>
+
+        Returns the approximate weather conditions for a given city.
+        """
+        obs = self._observe('cnn', loc, self._cnnObservation)
+        s = self._timings.time('convert', self._cnnFormat, obs, msg.args[0])
+        if s:
+            self._timings.time('reply', irc.reply, s)
         else:
             irc.errorPossibleBug('Could not find weather information.')
     cnn = wrap(cnn, ['text'])
@@ -317,13 +2095,11 @@ class Weather(callbacks.Plugin):
                      'findweather/getForecast?query='
         _wunderSevere = re.compile(r'font color="?#ff0000"?>([^<]+)<', re.I)
         _wunderMultiLoc = re.compile(r'<a href="([^"]+)', re.I | re.S)
-        def wunder(self, irc, msg, args, loc):
-            """<US zip code | US/Canada city, state | Foreign city, country>
-
-            Returns the approximate weather conditions for a given city.
-            """
+        def _wunderStation(self, loc):
+            """Returns the URL of the page with loc's conditions, following
+            the "Place: Temperature" list if the search was ambiguous."""
             url = '%s%s' % (self._wunderUrl, utils.web.urlquote(loc))
-            text = utils.web.getUrl(url)
+            text = Weather._fetch('wunder', url)
             if 'Search not found' in text or \
                re.search(r'size="2"> Place </font>', text, re.I):
                 Weather._noLocation()
@@ -331,12 +2107,159 @@ class Weather(callbacks.Plugin):
                 m = self._backupUrl.search(text)
                 if m is not None:
                     url = 'http://mobile.wunderground.com' + m.group(1)
-                    text = utils.web.getUrl(url)
-            severe = ''
+                    return url
+            Weather._resolvedPage('wunder', url, text)
+            return url
+
+        def _wunderObservation(self, loc):
+            url = Weather._resolve('wunder', loc, self._wunderStation)
+            text = Weather._fetchResolved('wunder', url)
+            severe = None
             m = self._wunderSevere.search(text)
             if m:
-                severe = ircutils.bold(format('  %s', m.group(1)))
+                severe = m.group(1)
             text = self._formatSymbols(text)
+            table = self._wunderTable(text)
+            if table is None:
+                table = self._wunderSoup(text)
+            (time, location, info) = table
+            return {'time': time, 'location': location, 'info': info,
+                    'severe': severe}
+
+        _wunderTableTag = re.compile(r'<table\b([^>]*)>(.*?)</table>',
+                                     re.I | re.S)
+        _wunderBorder = re.compile(r'\bborder\s*=\s*(?:"1"|\'1\'|1(?!\S))',
+                                   re.I)
+        _wunderToken = re.compile(r'<(/?)([a-z]\w*)\b[^<>]*>|([^<]+)', re.I)
+        _wunderInline = ('a', 'b', 'em', 'font', 'i', 'span', 'strong')
+        def _wunderTable(self, text):
+            """Returns the (time, location, info) read from the conditions
+            table in text, just as _wunderSoup would, without building a
+            parse tree of the whole page.
+
+            Only simple, well-formed markup is handled; None is returned for
+            anything else, which is left to _wunderSoup.
+            """
+            for m in self._wunderTableTag.finditer(text):
+                if self._wunderBorder.search(m.group(1)):
+                    break
+            else:
+                return None
+            html = m.group(2)
+            # BeautifulSoup rewrites these before parsing.
+            if '<table' in html.lower() or '/>' in html or \
+               re.search('[\x80-\x9f]', html):
+                return None
+            rows = self._wunderNodes(html)
+            if not rows:
+                return None
+            header = self._wunderFind(rows[0], 'b')
+            if len(header) != 2:
+                return None
+            (time, location) = map(self._wunderString, header)
+            info = {}
+            for row in rows[1:]:
+                cells = self._wunderFind(row, 'td')
+                if len(cells) < 2 or self._wunderString(cells[0]) is None:
+                    return None
+                value = []
+                for t in cells[1][1]:
+                    if isinstance(t, str) or not t[1]:
+                        continue
+                    s = self._wunderText(t)
+                    if s is None:
+                        return None
+                    value.append(s)
+                info[self._wunderString(cells[0])] = ' '.join(value)
+            if time is None or location is None:
+                return None
+            return (time, location, info)
+
+        def _wunderNodes(self, html):
+            """Returns the rows of the table html as lists of text and
+            (name, children) nodes, or None if it holds markup other than
+            rows of cells of inline tags, each explicitly closed."""
+            root = []
+            stack = [(None, root)]
+            pos = 0
+            for m in self._wunderToken.finditer(html):
+                if m.start() != pos:
+                    return None
+                pos = m.end()
+                (close, name, text) = m.groups()
+                (parent, children) = stack[-1]
+                if text is not None:
+                    # As BeautifulSoup does, collapse whitespace between tags.
+                    if not text.strip():
+                        text = '\n' in text and '\n' or ' '
+                    children.append(text)
+                    continue
+                name = name.lower()
+                if close:
+                    if name != parent:
+                        return None
+                    stack.pop()
+                    continue
+                if name == 'tr':
+                    nests = parent is None
+                elif name == 'td':
+                    nests = parent == 'tr'
+                elif name in self._wunderInline:
+                    nests = parent not in (None, 'tr') and \
+                            name not in [n for (n, _) in stack]
+                else:
+                    nests = False
+                if not nests:
+                    return None
+                node = (name, [])
+                children.append(node)
+                stack.append(node)
+            if pos != len(html) or len(stack) != 1:
+                return None
+            return [node for node in root if not isinstance(node, str)]
+
+        def _wunderFind(self, node, name):
+            L = []
+            for child in node[1]:
+                if not isinstance(child, str):
+                    if child[0] == name:
+                        L.append(child)
+                    L.extend(self._wunderFind(child, name))
+            return L
+
+        def _wunderString(self, node):
+            """Returns what BeautifulSoup's .string would for node."""
+            if isinstance(node, str):
+                return node
+            if len(node[1]) == 1 and isinstance(node[1][0], str):
+                return node[1][0]
+            return None
+
+        def _wunderText(self, node):
+            s = self._wunderString(node)
+            if s is None:
+                children = node[1]
+                if len(children) < 2:
+                    return None
+                num = self._wunderString(children[0])
+                units = self._wunderString(children[1])
+                if num is None or units is None:
+                    return None
+                # htmlToText strips leading whitespace, so we have to handle
+                # strings with &nbsp; differently.
+                if units.startswith('&nbsp;'):
+                    units = utils.web.htmlToText(units)
+                    s = ' '.join((num, units))
+                else:
+                    units = utils.web.htmlToText(units)
+                    if not units:
+                        return None
+                    s = ' '.join((num, units[0], units[1:]))
+            return s
+
+        def _wunderSoup(self, text):
+            """Returns the (time, location, info) read from the conditions
+            table in text using BeautifulSoup."""
             soup = BeautifulSoup.BeautifulSoup()
             soup.feed(text)
             # Get the table with all the weather info
@@ -345,8 +2268,6 @@ class Weather(callbacks.Plugin):
                 Weather._noLocation()
             trs = table.fetch('tr')
             (time, location) = trs.pop(0).fetch('b')
-            time = time.string
-            location = location.string
             info = {}
             def isText(t):
                 return not isinstance(t, BeautifulSoup.NavigableText) \
@@ -370,44 +2291,74 @@ class Weather(callbacks.Plugin):
                 k = tr.td.string
                 v = filter(isText, tr.fetch('td')[1].contents)
                 value = map(getText, v)
-                info[k] = ' '.join(value)
+                info[str(k)] = ' '.join(value)
+            # Keep plain strings rather than pieces of the soup, so the cached
+            # observation doesn't hold on to the whole parse tree.
+            return (str(time.string), str(location.string), info)
+
+        def _wunderFormat(self, obs, channel):
+            info = obs['info']
+            location = obs['location']
             temp = info['Temperature']
-            if location and temp:
-                (temp, deg, unit) = temp.split()[3:] # We only want temp format
-                temp = Weather._getTemp(float(temp), deg, unit, msg.args[0])
-                resp = ['The current temperature in %s is %s (%s).' %\
-                        (location, temp, time)]
-                conds = info['Conditions']
-                resp.append('Conditions: %s.' % info['Conditions'])
-                humidity = info['Humidity']
-                resp.append('Humidity: %s.' % info['Humidity'])
-                # Apparently, the "Dew Point" and "Wind" categories are
-                # occasionally set to "-" instead of an actual reading. So,
-                # we'll just catch the ValueError from trying to unpack a tuple
-                # of the wrong size.
-                try:
-                    (dew, deg, unit) = info['Dew Point'].split()[3:]
-                    dew = Weather._getTemp(float(dew), deg, unit, msg.args[0])
-                    resp.append('Dew Point: %s.' % dew)
-                except (ValueError, KeyError):
-                    pass
-                try:
-                    wind = 'Wind: %s at %s %s.' % tuple(info['Wind'].split())
-                    resp.append(wind)
-                except (ValueError, TypeError):
-                    pass
-                try:
-                    (chill, deg, unit) = info['Windchill'].split()[3:]
-                    chill = Weather._getTemp(float(chill), deg,
-                                             unit, msg.args[0])
-                    resp.append('Windchill: %s.' % chill)
-                except (ValueError, KeyError):
-                    pass
-                if info['Pressure']:
-                    resp.append('Pressure: %s.' % info['Pressure'])
-                resp.append(severe)
-                resp = map(utils.web.htmlToText, resp)
-                irc.reply(' '.join(resp).decode('latin1').encode('utf-8'))
+            if not (location and temp):
+                return None
+            (temp, deg, unit) = temp.split()[3:] # We only want temp format
+            temp = Weather._getTemp(float(temp), deg, unit, channel)
+            resp = ['The current temperature in %s is %s (%s).' %\
+                    (location, temp, obs['time'])]
+            resp.append('Conditions: %s.' % info['Conditions'])
+            resp.append('Humidity: %s.' % info['Humidity'])
+            # Apparently, the "Dew Point" and "Wind" categories are
+            # occasionally set to "-" instead of an actual reading. So,
+            # we'll just catch the ValueError from trying to unpack a tuple
+            # of the wrong size.
+            try:
+                (dew, deg, unit) = info['Dew Point'].split()[3:]
+                dew = Weather._getTemp(float(dew), deg, unit, channel)
+                resp.append('Dew Point: %s.' % dew)
+            except (ValueError, KeyError):
+                pass
+            try:
+                wind = 'Wind: %s at %s %s.' % tuple(info['Wind'].split())
+                resp.append(wind)
+            except (ValueError, TypeError):
+                pass
+            try:
+                (chill, deg, unit) = info['Windchill'].split()[3:]
+                chill = Weather._getTemp(float(chill), deg, unit, channel)
+                resp.append('Windchill: %s.' % chill)
+            except (ValueError, KeyError):
+                pass
+            if info['Pressure']:
+                resp.append('Pressure: %s.' % info['Pressure'])
+            severe = ''
+            if obs['severe']:
+                severe = ircutils.bold(format('  %s', obs['severe']))
+            resp.append(severe)
+            resp = map(utils.web.htmlToText, resp)
+            return ' '.join(resp).decode('latin1').encode('utf-8')
+
+        def _wunderSummary(self, obs, channel):
+            info = obs['info']
+            try:
+                (temp, deg, unit) = info['Temperature'].split()[3:]
+            except (ValueError, KeyError):
+                return None
+            temp = Weather._getTemp(float(temp), deg, unit, channel)
+            if info.get('Conditions'):
+                return format('%s, %s', temp, info['Conditions'])
+            return temp
+
+        def wunder(self, irc, msg, args, loc):
+            """<US zip code | US/Canada city, state | Foreign city, country>
+
+            Returns the approximate weather conditions for a given city.
+            """
+            obs = Weather._observe('wunder', loc, self._wunderObservation)
+            s = Weather._timings.time('convert', self._wunderFormat, obs,
+                                      msg.args[0])
+            if s:
+                Weather._timings.time('reply', irc.reply, s)
             else:
                 Weather._noLocation()
         wunder = wrap(wunder, ['text'])
@@ -422,14 +2373,17 @@ class Weather(callbacks.Plugin):
             r'<title>(?:(.*) Weather from Weather Underground|'
             r'Weather Underground - (.*))</title>', re.I)
         _rsswunderForecastDate = re.compile(r'Forecast for (.*) as of', re.I)
-        def rss(self, irc, msg, args, loc):
-            """<US zip code | US/Canada city, state | Foreign city, country>
-
-            Returns the approximate weather conditions for a given city.
-            """
+        # Station pages are only read for their feed and severe weather alert,
+        # and any alert comes before the main part of the page.  The alert is
+        # optional, so it's the main part that tells us to stop.
+        _rsswunderMain = re.compile(r'<div id="main"', re.I)
+        _rssFields = (_rsswunderfeed, _rsswunderMain)
+        def _rssStation(self, loc):
+            """Returns the URLs of loc's station page and RSS feed, following
+            the "Search Results" list if the search was ambiguous."""
             url = self._rsswunderUrl % utils.web.urlquote(loc)
             url = url.replace('%20', '+')
-            text = utils.web.getUrl(url)
+            text = Weather._fetch('wunder rss', url)
             if 'Search not found' in text or \
                re.search(r'size="2"> Place </font>', text, re.I):
                 Weather._noLocation()
@@ -437,42 +2391,100 @@ class Weather(callbacks.Plugin):
                 m = self._backupUrl.search(text)
                 if m is not None:
                     url = 'http://www.wunderground.com' + m.group(1)
-                    text = utils.web.getUrl(url)
+                    text = Weather._fetch('wunder rss', url)
                 else:
                     Weather._noLocation()
-            self._rss(irc, text)
+            feed = self._rsswunderfeed.search(text)
+            if not feed:
+                Weather._noLocation()
+            Weather._resolvedPage('wunder rss', url, text)
+            return {'page': url, 'feed': feed.group(1)}
+
+        def _rssObservation(self, loc):
+            station = Weather._resolve('wunder rss', loc, self._rssStation)
+            # The feed doesn't carry severe weather alerts, so the station
+            # page is still needed for those.
+            text = Weather._fetchResolved('wunder rss', station['page'],
+                                          self._rssFields)
+            return self._rss(text, station['feed'])
+
+        def _rssFormat(self, obs, channel):
+            resp = []
+            if obs['location']:
+                resp.append('Weather for %s' % obs['location'])
+            resp.extend(obs['forecasts'])
+            resp = [s.encode('utf-8').rstrip('.') for s in resp]
+            if obs['severe'] is not None:
+                resp.append(ircutils.bold(obs['severe']))
+            return utils.web.htmlToText('; '.join(resp))
+
+        def rss(self, irc, msg, args, loc):
+            """<US zip code | US/Canada city, state | Foreign city, country>
+
+            Returns the approximate weather conditions for a given city.
+            """
+            obs = Weather._observe('wunder rss', loc, self._rssObservation)
+            s = Weather._timings.time('convert', self._rssFormat, obs,
+                                      msg.args[0])
+            Weather._timings.time('reply', irc.reply, s)
         rss = wrap(rss, ['text'])
 
-        def _rss(self, irc, text):
-            severe = None
+        def _rss(self, text, feed):
+            obs = {'location': None, 'forecasts': [], 'severe': None}
             m = self._rsswunderSevere.search(text)
             if m:
-                severe = ircutils.bold(m.group(1))
-            feed = self._rsswunderfeed.search(text)
-            if not feed:
-                Weather._noLocation()
-            feed = feed.group(1)
-            rss = utils.web.getUrl(feed)
+                obs['severe'] = m.group(1)
+            (obs['location'], obs['forecasts']) = self._feed(feed)
+            return obs
+
+        _feeds = ExpiringCache()
+        _feedTtl = 24 * 60 * 60
+        def _feed(self, url):
+            """Returns the (location, forecasts) read from the RSS feed at
+            url.
+
+            The feed's ETag and Last-Modified validators are remembered, so
+            an unchanged feed is neither downloaded nor parsed again.
+            """
+            headers = dict(utils.web.defaultHeaders)
+            cached = self._feeds.get(url)
+            if cached is not None:
+                (etag, modified, parsed) = cached
+                if etag:
+                    headers['If-None-Match'] = etag
+                if modified:
+                    headers['If-Modified-Since'] = modified
+            (status, responseHeaders, rss) = \
+                     Weather._timings.time('fetch', Weather._request,
+                                           'wunder rss', url, headers)
+            if status == 304 and cached is not None:
+                self._feeds.set(url, cached, self._feedTtl)
+                return parsed
             rss = self._formatSymbols(rss)
             rss = rss.replace(":", ": ")
             rss = rss.replace(":  ", ": ")
-            resp = []
-            location = self._rsswunderLocation.search(rss)
-            if location is not None:
-                title = filter(None, location.groups())
+            location = None
+            m = self._rsswunderLocation.search(rss)
+            if m is not None:
+                title = filter(None, m.groups())
                 if title:
-                    resp.append('Weather for %s' % title[0])
+                    location = title[0]
+            forecasts = []
             info = feedparser.parse(rss)
             for e in info['entries']:
                 d = self._rsswunderForecastDate.search(e['title'])
                 if d is not None:
-                    resp.append(d.group(1) + ' - Conditions: ' + e['summary'])
+                    forecasts.append(d.group(1) + ' - Conditions: ' +
+                                     e['summary'])
                 else:
-                    resp.append(e['summary'])
-            resp = [s.encode('utf-8').rstrip('.') for s in resp]
-            if severe is not None:
-                resp.append(severe)
-            irc.reply(utils.web.htmlToText('; '.join(resp)))
+                    forecasts.append(e['summary'])
+            parsed = (location, forecasts)
+            etag = responseHeaders.get('etag')
+            modified = responseHeaders.get('last-modified')
+            if etag or modified:
+                self._feeds.size = conf.supybot.plugins.Weather.cache.size()
+                self._feeds.set(url, (etag, modified, parsed), self._feedTtl)
+            return parsed
 
         def _formatSymbols(self, text):
             text = text.replace("&amp;", "&")
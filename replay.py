@@ -0,0 +1,209 @@
+###
+# Copyright (c) 2005,2009, James Vega
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""Replays the provider responses recorded in fixtures/ in place of the
+network, so the weather commands can be tested and timed offline:
+
+    import replay
+    plugin.Weather._pool = replay.Replay()
+
+or, to go through the plugin's real HTTP code, served by a local stand-in
+for the providers:
+
+    server = replay.Server()
+    conf.supybot.protocols.http.proxy.setValue('%s:%s' %
+                                               server.server_address)
+    server.serve_forever()
+"""
+
+import os
+import gzip
+import time
+import random
+import socket
+import struct
+import urlparse
+import SocketServer
+import BaseHTTPServer
+from cStringIO import StringIO
+
+import supybot.utils as utils
+
+import plugin
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures')
+
+class Replay(object):
+    """Stands in for plugin.ConnectionPool, answering each request with the
+    response recorded for its URL in the directory's index.txt.
+
+    Requests for other URLs raise utils.web.Error, as they would if the
+    network were down.  Every requested URL is appended to requests.
+    """
+    def __init__(self, directory=fixtures):
+        self.directory = directory
+        self.responses = {}
+        self.bodies = {}
+        self.requests = []
+        fd = open(os.path.join(directory, 'index.txt'))
+        try:
+            for line in fd:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    (url, filename) = line.split()
+                    self.responses[url] = filename
+        finally:
+            fd.close()
+
+    def getUrl(self, url, headers=None, timeout=None, fields=(), budget=0):
+        return self.request(url, headers, timeout, fields, budget)[2]
+
+    def request(self, url, headers=None, timeout=None, fields=(), budget=0):
+        self.requests.append(url)
+        try:
+            filename = self.responses[url]
+        except KeyError:
+            raise utils.web.Error, 'No recorded response for %s.' % url
+        text = self._read(filename)
+        if fields and budget:
+            # Cut the page short just where the real pool would.
+            scanner = plugin.Scanner(fields, budget)
+            size = plugin.ConnectionPool.chunkSize
+            for i in xrange(0, len(text), size):
+                if scanner.feed(text[i:i+size]):
+                    break
+            text = scanner.text
+        return (200, {}, text)
+
+    def close(self):
+        pass
+
+    def _read(self, filename):
+        try:
+            return self.bodies[filename]
+        except KeyError:
+            fd = open(os.path.join(self.directory, filename), 'rb')
+            try:
+                text = self.bodies[filename] = fd.read()
+            finally:
+                fd.close()
+            return text
+
+def gzipped(text):
+    sio = StringIO()
+    fd = gzip.GzipFile(fileobj=sio, mode='wb')
+    fd.write(text)
+    fd.close()
+    return sio.getvalue()
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1 # Send each response in one go rather than line by line.
+    def setup(self):
+        self.timeout = self.server.idle
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        server = self.server
+        host = urlparse.urlsplit(self.path)[1]
+        time.sleep(server.latencies.get(host, server.latency))
+        if server.random.random() < server.failures:
+            if server.mode == 'reset':
+                # Linger for no time at all, so closing sends a RST.
+                self.connection.setsockopt(socket.SOL_SOCKET,
+                                           socket.SO_LINGER,
+                                           struct.pack('ii', 1, 0))
+                self.close_connection = 1
+            else:
+                self.respond(503, 'Injected failure.')
+            return
+        try:
+            filename = server.replay.responses[self.path]
+        except KeyError:
+            self.respond(404, 'No recorded response for %s.' % self.path)
+            return
+        self.respond(200, server.replay._read(filename))
+
+    def respond(self, status, body):
+        self.send_response(status)
+        accepted = self.headers.get('Accept-Encoding') or ''
+        if status == 200 and self.server.compress and 'gzip' in accepted:
+            body = gzipped(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves the responses recorded in directory over HTTP, as a proxy
+    would, so requests can be sent to it by pointing
+    supybot.protocols.http.proxy at its server_address.
+
+    Each response is delayed by latency seconds, or by the seconds given for
+    its host in latencies.  A random fraction, failures, of the requests
+    fail instead: with a 503 when mode is 'error', or by resetting the
+    connection when it's 'reset'.  Responses are gzipped for clients that
+    accept it when compress is set.  Connections left idle for idle seconds
+    are closed, as real servers do with keep-alive connections.
+
+    The number of connections accepted so far is kept in connections.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    modes = ('error', 'reset')
+    def __init__(self, address=('127.0.0.1', 0), directory=fixtures,
+                 latency=0, latencies=None, failures=0, mode='error',
+                 compress=False, seed=None, idle=None):
+        if mode not in self.modes:
+            raise ValueError, 'Unknown failure mode: %s' % mode
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.replay = Replay(directory)
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.failures = failures
+        self.mode = mode
+        self.compress = compress
+        self.random = random.Random(seed)
+        self.idle = idle
+        self.connections = 0
+
+    def process_request(self, request, address):
+        self.connections += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, address)
+
+    def handle_error(self, request, address):
+        # Clients hang up early on purpose (see ConnectionPool's fields), so
+        # a broken pipe here is nothing to report.
+        pass
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
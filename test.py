@@ -27,8 +27,22 @@
 # POSSIBILITY OF SUCH DAMAGE.
 ###
 
+import os
+import anydbm
+import re
+import gzip
+import pstats
+import httplib
+import time
+import zlib
+import threading
+from cStringIO import StringIO
+
 from supybot.test import *
 
+import plugin
+import replay
+
 class WeatherTestCase(PluginTestCase):
     plugins = ('Weather',)
     if network:
@@ -106,5 +120,893 @@ class WeatherTestCase(PluginTestCase):
                 conf.supybot.plugins.Weather.convert.setValue(convert)
                 conf.supybot.plugins.Weather.temperatureUnit.setValue(unit)
 
+    def testNegativeValuesRejected(self):
+        self.assertError('config plugins.Weather.limits.rate -1')
+        self.assertError('config plugins.Weather.fallback.hedgeDelay -0.5')
+        self.assertNotError('config plugins.Weather.fallback.hedgeDelay 0')
+        self.assertNotError('config plugins.Weather.fallback.hedgeDelay 1.0')
+
+class ReplayTestCase(ChannelPluginTestCase):
+    plugins = ('Weather',)
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        self.pool = plugin.Weather._pool
+        plugin.Weather._pool = replay.Replay()
+        for cache in (plugin.Weather._pages, plugin.Weather._observations,
+                      plugin.Weather._unknown, plugin.Weather._locations,
+                      plugin.Weather.wunder._feeds):
+            cache.clear()
+        plugin.Weather._stats.reset()
+
+    def tearDown(self):
+        ChannelPluginTestCase.tearDown(self)
+        plugin.Weather._pool = self.pool
+
+    def testHam(self):
+        self.assertResponse('ham Columbus, OH',
+                            'The current temperature in Columbus, OH is '
+                            '45.0\xc2\xb0F (Wind Chill: 40.0\xc2\xb0F). '
+                            'Conditions: Thunderstorms.')
+        self.assertResponse('ham Paris',
+                            'The current temperature in Paris, France is '
+                            '53.6\xc2\xb0F. Conditions: Light Rain.')
+        self.assertError('ham Nowhere')
+
+    def testCnn(self):
+        self.assertResponse('cnn Columbus, OH',
+                            'The current temperature in Columbus, OH is '
+                            '45.0\xb0F. Conditions: Partly Cloudy. '
+                            'Humidity: 65%. Wind: NW at 10 mph.')
+        self.assertError('cnn Nowhere')
+
+    def testCnnResolutionCached(self):
+        self.assertNotError('cnn Columbus, OH')
+        plugin.Weather._observations.clear()
+        plugin.Weather._pages.clear()
+        del plugin.Weather._pool.requests[:]
+        self.assertNotError('cnn Columbus, OH')
+        self.assertEqual(plugin.Weather._pool.requests,
+                         ['http://weather.cnn.com/weather/forecast.jsp?'
+                          'locCode=USOH0212&zipCode=43215'])
+
+    def testWunder(self):
+        self.assertResponse('wunder Columbus, OH',
+                            'The current temperature in Columbus, Ohio is '
+                            '44.6\xc2\xb0F (3:51 PM EDT on October 18, '
+                            '2010). Conditions: Partly Cloudy. Humidity: 65%. '
+                            'Dew Point: 33.8\xc2\xb0F. Wind: NW at 10 mph. '
+                            'Windchill: 41.0\xc2\xb0F. Pressure: 30.12 in. '
+                            '\x02 Wind Advisory in effect until 8 PM EDT\x02')
+        self.assertRegexp('wunder Paris', 'Paris, France is 53.6\xc2\xb0F')
+        self.assertError('wunder Nowhere')
+
+    def testWunderRss(self):
+        self.assertRegexp('wunder rss Columbus, OH',
+                          r'^Weather for Columbus, OH; Temperature: '
+                          r'45\xc2\xb0F / 7\xc2\xb0C \| Humidity: 65%')
+        self.assertRegexp('wunder rss Paris',
+                          r'^Weather for Paris, France; .*; Monday Night - '
+                          r'Conditions: Rain\. Low of 48 F')
+        self.assertError('wunder rss Nowhere')
+
+    def testResolvedPages(self):
+        ttl = conf.supybot.plugins.Weather.cache.ttl
+        requests = plugin.Weather._pool.requests
+        mobile = 'http://mobile.wunderground.com/'
+        www = 'http://www.wunderground.com/'
+        try:
+            ttl.wunder.setValue(0)
+            ttl.wunderRss.setValue(0)
+            self.assertNotError('wunder Columbus, OH')
+            self.assertEqual(requests, [mobile + 'cgi-bin/findweather/'
+                                        'getForecast?query=Columbus%2C%20OH'])
+            del requests[:]
+            self.assertNotError('wunder Paris')
+            self.assertNotError('wunder Paris')
+            self.assertEqual(requests,
+                             [mobile + 'cgi-bin/findweather/'
+                              'getForecast?query=Paris',
+                              mobile + 'global/stations/07150.html',
+                              mobile + 'global/stations/07150.html'])
+            del requests[:]
+            self.assertNotError('wunder rss Paris')
+            self.assertEqual([url for url in requests if url.startswith(www)],
+                             [www + 'cgi-bin/findweather/'
+                              'getForecast?query=Paris',
+                              www + 'global/stations/07150.html'])
+        finally:
+            ttl.wunder.setValue(300)
+            ttl.wunderRss.setValue(900)
+
+    def testTimings(self):
+        timings = []
+        plugin.Weather._timings.sinks.append(timings.append)
+        try:
+            self.assertNotError('ham Columbus, OH')
+            self.assertNotError('ham Columbus, OH')
+            self.assertError('cnn Nowhere')
+        finally:
+            plugin.Weather._timings.sinks.remove(timings.append)
+        self.assertEqual([(t.command, t.location, t.ok) for t in timings],
+                         [('ham', 'Columbus, OH', True),
+                          ('ham', 'Columbus, OH', True),
+                          ('cnn', 'Nowhere', False)])
+        self.failUnless(timings[0].seconds['fetch'] > 0)
+        self.failUnless(timings[0].seconds['parse'] > 0)
+        # The second reply comes from the cache.
+        self.assertEqual(timings[1].seconds['fetch'], 0)
+        self.assertEqual(timings[1].seconds['parse'], 0)
+        for t in timings:
+            self.failUnless(sum(t.seconds.values()) <= t.total)
+
+    def testStats(self):
+        self.assertNotError('ham Columbus, OH')
+        self.assertError('ham Nowhere')
+        self.assertNotError('config plugins.Weather.command cnn')
+        try:
+            self.assertNotError('weather Paris')
+        finally:
+            self.assertNotError('config plugins.Weather.command wunder')
+        m = self.assertRegexp('weather stats',
+                              r'ham: 2 requests, 1 found, 1 not found, '
+                              r'0 web errors, 0 fallbacks, [\d.]+ms mean, '
+                              r'[\d.]+ms p95, [1-9][\d.]*KB$')
+        self.failUnless('cnn: 1 request, 0 found, 1 not found, 0 web errors'
+                        in m.args[1])
+        self.failUnless('wunder: 1 request, 1 found, 0 not found, 0 web '
+                        'errors, 1 fallback' in m.args[1])
+        self.assertNotError('weather stats --reset')
+        self.assertRegexp('weather stats', 'ham: 0 requests')
+
+    def testProfile(self):
+        profile = conf.supybot.plugins.Weather.profile
+        directory = conf.supybot.directories.data.dirize(profile.directory())
+        profile.sample.setValue(1)
+        profile.keep.setValue(2)
+        try:
+            self.assertNotError('ham Columbus, OH')
+            self.assertNotError('cnn Columbus, OH')
+            self.assertNotError('wunder Columbus, OH')
+        finally:
+            profile.sample.setValue(0)
+            profile.keep.setValue(50)
+        filenames = sorted(os.listdir(directory))
+        self.assertEqual(len(filenames), 2)
+        self.failUnless(filenames[0].endswith('-cnn-Columbus_OH.pstats'))
+        self.failUnless(filenames[1].endswith('-wunder-Columbus_OH.pstats'))
+        stats = pstats.Stats(os.path.join(directory, filenames[1]))
+        self.failUnless([f for f in stats.stats if f[2] == 'wunder'])
+
+    def testBatch(self):
+        self.assertResponse('weather batch Columbus, OH | Paris | Nowhere | '
+                            'columbus, oh',
+                            'Columbus, OH: 44.6\xc2\xb0F, Partly Cloudy; '
+                            'Paris: 53.6\xc2\xb0F, Light Rain; '
+                            'Nowhere: not found')
+        self.assertNotError('config plugins.Weather.command cnn')
+        try:
+            self.assertResponse('weather batch Paris | Columbus, OH',
+                                'Paris: 53.6\xc2\xb0F, Light Rain; '
+                                'Columbus, OH: 45.0\xc2\xb0F, Partly Cloudy')
+        finally:
+            self.assertNotError('config plugins.Weather.command wunder')
+        self.assertError('weather batch ' + ' | '.join(map(str, range(11))))
+
+    def testBroadcast(self):
+        self.irc.feedMsg(ircmsgs.join('#other', prefix=self.prefix))
+        while self.irc.takeMsg():
+            pass
+        unit = conf.supybot.plugins.Weather.temperatureUnit
+        try:
+            self.assertNotError('weather subscribe Columbus, OH')
+            self.assertNotError('weather subscribe columbus, oh')
+            self.assertNotError('weather subscribe Paris')
+            self.assertResponse('weather subscriptions',
+                                '"Columbus, OH" and "Paris"')
+            self.assertNotError('weather subscribe #other Columbus, OH')
+            self.assertNotError('weather unsubscribe Paris')
+            self.assertError('weather unsubscribe Paris')
+            unit.get('#other').setValue('C')
+            self.irc.getCallback('Weather')._broadcast()
+            msgs = []
+            started = time.time()
+            while len(msgs) < 2 and time.time() - started < self.timeout:
+                m = self.irc.takeMsg()
+                if m is None:
+                    time.sleep(0.05)
+                else:
+                    msgs.append(m)
+        finally:
+            conf.supybot.plugins.Weather.broadcast.locations.get('#test') \
+                .setValue([])
+            conf.supybot.plugins.Weather.broadcast.locations.get('#other') \
+                .setValue([])
+            unit.get('#other').setValue(unit())
+        msgs.sort(key=lambda m: m.args[0])
+        self.assertEqual([m.args[0] for m in msgs], ['#other', '#test'])
+        self.failUnless('Columbus, Ohio is 7.0\xc2\xb0C' in msgs[0].args[1])
+        self.failUnless('Columbus, Ohio is 44.6\xc2\xb0F' in msgs[1].args[1])
+        # Both channels' replies came from a single lookup.
+        self.assertEqual(plugin.Weather._pool.requests,
+            ['http://mobile.wunderground.com/cgi-bin/findweather/'
+             'getForecast?query=Columbus%2C%20OH'])
+
+    def testBroadcastSplits(self):
+        command = conf.supybot.plugins.Weather.command
+        locations = conf.supybot.plugins.Weather.broadcast.locations
+        orig = command()
+        try:
+            command.setValue('wunder rss')
+            locations.get('#test').setValue(['Paris'])
+            self.irc.getCallback('Weather')._broadcast()
+            msgs = []
+            started = time.time()
+            while len(msgs) < 2 and time.time() - started < self.timeout:
+                m = self.irc.takeMsg()
+                if m is None:
+                    time.sleep(0.05)
+                else:
+                    msgs.append(m)
+        finally:
+            command.setValue(orig)
+            locations.get('#test').setValue([])
+        self.failUnless(len(msgs) > 1)
+        self.failUnless(msgs[0].args[1].startswith('Weather for Paris'))
+        for m in msgs:
+            self.assertEqual(m.args[0], '#test')
+            self.failUnless(len(str(m)) <= 512)
+
+    def testWeatherFallsBack(self):
+        self.assertNotError('config plugins.Weather.command cnn')
+        try:
+            self.assertRegexp('weather Paris', 'Paris, France')
+            self.assertError('weather Nowhere')
+        finally:
+            self.assertNotError('config plugins.Weather.command wunder')
+
+class ReplayServerTestCase(SupyTestCase):
+    url = 'http://mobile.wunderground.com/global/stations/07150.html'
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.servers = []
+        self.proxy = conf.supybot.protocols.http.proxy()
+
+    def tearDown(self):
+        conf.supybot.protocols.http.proxy.setValue(self.proxy)
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        SupyTestCase.tearDown(self)
+
+    def serve(self, **kwargs):
+        server = replay.Server(**kwargs)
+        self.servers.append(server)
+        t = threading.Thread(target=server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        conf.supybot.protocols.http.proxy.setValue('%s:%s' %
+                                                   server.server_address)
+        return plugin.ConnectionPool()
+
+    def testServes(self):
+        pool = self.serve(compress=True)
+        (status, headers, text) = pool.request(self.url)
+        self.assertEqual(text, readFixture('wunder-mobile-paris.html'))
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertRaises(utils.web.Error, pool.getUrl,
+                          'http://example.com/')
+
+    def testFailures(self):
+        pool = self.serve(failures=1)
+        self.assertRaises(utils.web.Error, pool.getUrl, self.url)
+        pool = self.serve(failures=1, mode='reset')
+        self.assertRaises(utils.web.Error, pool.getUrl, self.url)
+
+    def testReusesConnections(self):
+        pool = self.serve()
+        for _ in range(3):
+            self.assertEqual(pool.getUrl(self.url),
+                             readFixture('wunder-mobile-paris.html'))
+        self.assertEqual(self.servers[-1].connections, 1)
+
+    def testReusesConnectionsAfterFields(self):
+        pool = self.serve(compress=True)
+        url = 'http://www.hamweather.net/cgi-bin/hw3/hw3.cgi?config=&' \
+              'forecast=zandh&pands=columbus%2C%20oh&Submit=GO'
+        for _ in range(3):
+            text = pool.getUrl(url, fields=plugin.Weather._hamFields,
+                               budget=65536)
+            self.failUnless(readFixture('ham-columbus.html').startswith(text))
+        self.assertEqual(self.servers[-1].connections, 1)
+
+    def testRssFields(self):
+        pool = self.serve()
+        fields = plugin.Weather.wunder._rssFields
+        url = 'http://www.wunderground.com/cgi-bin/findweather/' \
+              'getForecast?query=Columbus%2C+OH'
+        text = pool.getUrl(url, fields=fields, budget=65536)
+        self.failUnless('Wind Advisory' in text)
+        # Paris has no alert, but there's no need to read the whole page to
+        # find that out.
+        url = 'http://www.wunderground.com/global/stations/07150.html'
+        text = pool.getUrl(url, fields=fields, budget=65536)
+        self.failUnless(len(text) < len(readFixture('wunder-paris.html')))
+
+    def testIdleConnectionClosed(self):
+        pool = self.serve(idle=0.1)
+        pool.getUrl(self.url)
+        time.sleep(0.3)
+        self.assertEqual(pool.getUrl(self.url),
+                         readFixture('wunder-mobile-paris.html'))
+        self.assertEqual(self.servers[-1].connections, 2)
+
+    def testTimeoutNotRetried(self):
+        pool = self.serve()
+        pool.getUrl(self.url)
+        self.servers[-1].latency = 1
+        started = time.time()
+        self.assertRaises(utils.web.Error, pool.getUrl, self.url,
+                          timeout=0.3)
+        self.failUnless(time.time() - started < 0.6)
+        self.assertEqual(self.servers[-1].connections, 1)
+
+    def testLatency(self):
+        pool = self.serve(latency=0.2)
+        start = time.time()
+        pool.getUrl(self.url)
+        self.failUnless(time.time() - start >= 0.2)
+
+class ObservationCacheTestCase(PluginTestCase):
+    plugins = ('Weather',)
+    def testObservationsAreShared(self):
+        calls = []
+        def lookup(loc):
+            calls.append(loc)
+            return {'location': loc}
+        plugin.Weather._observations.clear()
+        self.assertEqual(plugin.Weather._observe('ham', 'Columbus, OH',
+                                                 lookup),
+                         {'location': 'Columbus, OH'})
+        plugin.Weather._observe('ham', 'columbus,  oh', lookup)
+        self.assertEqual(calls, ['Columbus, OH'])
+        plugin.Weather._observe('cnn', 'Columbus, OH', lookup)
+        self.assertEqual(len(calls), 2)
+
+    def testUnknownLocationsAreRemembered(self):
+        calls = []
+        def lookup(loc):
+            calls.append(loc)
+            plugin.Weather._noLocation()
+        plugin.Weather._unknown.clear()
+        for _ in range(2):
+            self.assertRaises(plugin.NoLocation, plugin.Weather._observe,
+                              'ham', 'alsdkfjasdl, asdlfkjsadlfkj', lookup)
+        self.assertEqual(len(calls), 1)
+
+class FallbackTestCase(ChannelPluginTestCase):
+    plugins = ('Weather',)
+    def testHedgedLookupUsesFirstGoodReply(self):
+        cb = self.irc.getCallback('Weather')
+        def lookup(command, loc, channel):
+            if command == 'cnn':
+                return 'cnn knows %s' % loc
+            raise plugin.NoLocation
+        cb._lookup = lookup
+        try:
+            self.assertEqual(cb._hedgedLookup(['wunder', 'cnn', 'ham'],
+                                              'Columbus, OH', self.channel),
+                             'cnn knows Columbus, OH')
+            self.assertEqual(cb._hedgedLookup(['wunder', 'ham'],
+                                              'Columbus, OH', self.channel),
+                             None)
+        finally:
+            del cb._lookup
+
+    def testAdaptiveOrder(self):
+        cb = self.irc.getCallback('Weather')
+        health = plugin.Weather._health
+        health.samples.clear()
+        try:
+            conf.supybot.plugins.Weather.fallback.adaptive.setValue(True)
+            for _ in range(3):
+                health.record('ham', True, 0.5)
+                health.record('cnn', True, 2.0)
+                health.record('wunder rss', False, 10.0)
+            self.assertEqual(cb._fallbackOrder('wunder'),
+                             ['wunder', 'ham', 'cnn', 'wunder rss'])
+            # Commands without any recent lookups are tried optimistically.
+            self.assertEqual(cb._fallbackOrder('wunder rss'),
+                             ['wunder', 'ham', 'cnn', 'wunder rss'])
+            # A provider that fails straight away is no better for it.
+            health.samples.clear()
+            for _ in range(10):
+                health.record('ham', False, 0.002)
+                health.record('cnn', True, 0.4)
+            self.assertEqual(cb._fallbackOrder('ham'),
+                             ['wunder', 'wunder rss', 'cnn', 'ham'])
+            self.assertEqual(cb._fallbackOrder('wunder'),
+                             ['wunder', 'wunder rss', 'cnn', 'ham'])
+        finally:
+            conf.supybot.plugins.Weather.fallback.adaptive.setValue(False)
+            health.samples.clear()
+        self.assertEqual(cb._fallbackOrder('cnn'),
+                         ['cnn', 'wunder', 'wunder rss', 'ham'])
+
+    def testHealthFailures(self):
+        health = plugin.ProviderHealth()
+        def fail(e):
+            raise e
+        self.assertRaises(plugin.NoLocation, health.measure, 'ham', fail,
+                          plugin.NoLocation())
+        self.assertEqual(health.successRate('ham'), 1.0)
+        self.assertRaises(utils.web.Error, health.measure, 'ham', fail,
+                          plugin.ProviderUnavailable())
+        self.assertEqual(health.successRate('ham'), 0.5)
+
+class FeedTestCase(PluginTestCase):
+    plugins = ('Weather',)
+    url = 'http://rss.wunderground.com/auto/rss_full/OH/Columbus.xml' \
+          '?units=both'
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.pool = plugin.Weather._pool
+        self.parse = plugin.feedparser.parse
+        plugin.Weather.wunder._feeds.clear()
+
+    def tearDown(self):
+        plugin.Weather._pool = self.pool
+        plugin.feedparser.parse = self.parse
+        PluginTestCase.tearDown(self)
+
+    def testNotModified(self):
+        class Pool(object):
+            def __init__(self, responses):
+                self.responses = responses
+                self.headers = []
+            def request(self, url, headers=None, timeout=None, fields=(),
+                        budget=0):
+                self.headers.append(headers)
+                return self.responses.pop(0)
+        modified = 'Mon, 18 Oct 2010 19:51:00 GMT'
+        pool = Pool([(200, {'etag': '"1"', 'last-modified': modified},
+                      readFixture('wunder-rss-columbus.xml')),
+                     (304, {}, '')])
+        plugin.Weather._pool = pool
+        parses = []
+        def parse(*args):
+            parses.append(args)
+            return self.parse(*args)
+        plugin.feedparser.parse = parse
+        cb = plugin.Weather.wunder()
+        parsed = cb._feed(self.url)
+        self.assertEqual(parsed[0], 'Columbus, OH')
+        self.failIf('If-None-Match' in pool.headers[0])
+        self.failUnless(cb._feed(self.url) is parsed)
+        self.assertEqual(pool.headers[1]['If-None-Match'], '"1"')
+        self.assertEqual(pool.headers[1]['If-Modified-Since'], modified)
+        self.assertEqual(len(parses), 1)
+
+class ExpiringCacheTestCase(SupyTestCase):
+    def testExpiry(self):
+        cache = plugin.ExpiringCache()
+        cache.set('foo', 'bar', 60)
+        self.assertEqual(cache.get('foo'), 'bar')
+        cache.set('foo', 'baz', -1)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(len(cache), 0)
+
+    def testStaleEntries(self):
+        cache = plugin.ExpiringCache(grace=60)
+        cache.set('foo', 'bar', -1)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('foo', stale=True), 'bar')
+
+    def testLeastRecentlyUsedIsEvicted(self):
+        cache = plugin.ExpiringCache(2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        cache.get('a')
+        cache.set('c', 3, 60)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+    def testNormalizeUrl(self):
+        self.assertEqual(plugin.normalizeUrl('HTTP://Weather.CNN.com?a=B#x'),
+                         'http://weather.cnn.com/?a=B')
+
+class DiskCacheTestCase(SupyTestCase):
+    def testEntriesSurviveReopening(self):
+        filename = conf.supybot.directories.data.dirize('WeatherTest.db')
+        disk = plugin.DiskCache(filename)
+        disk.set(('observation', 'ham', 'columbus, oh'), {'city': 'Columbus'},
+                 60)
+        disk.set(('observation', 'cnn', 'columbus, oh'), {}, -1)
+        disk.close()
+        disk = plugin.DiskCache(filename)
+        try:
+            (obs, ttl) = disk.get(('observation', 'ham', 'columbus, oh'))
+            self.assertEqual(obs, {'city': 'Columbus'})
+            self.failUnless(0 < ttl <= 60)
+            self.assertEqual(disk.get(('observation', 'cnn', 'columbus, oh')),
+                             (None, 0))
+        finally:
+            disk.close()
+
+    def testExpiredEntriesSwept(self):
+        filename = conf.supybot.directories.data.dirize('WeatherSweep.db')
+        key = ('observation', 'cnn', 'nowhere')
+        disk = plugin.DiskCache(filename)
+        disk.set(key, {}, -1)
+        disk.close()
+        # Reopening the file sweeps out the entry, even though it's never
+        # looked up again.
+        plugin.DiskCache(filename).close()
+        db = anydbm.open(filename)
+        try:
+            self.failIf('\x00'.join(key) in db.keys())
+        finally:
+            db.close()
+
+class CircuitBreakerTestCase(SupyTestCase):
+    def testOpensAndProbes(self):
+        breaker = plugin.CircuitBreaker()
+        for _ in range(3):
+            self.failUnless(breaker.allow(60))
+            breaker.failed(3)
+        self.failIf(breaker.allow(60))
+        # Once the cooldown is over, exactly one probe is let through.
+        self.failUnless(breaker.allow(0))
+        self.failIf(breaker.allow(0))
+        breaker.failed(3)
+        self.failIf(breaker.allow(60))
+        self.failUnless(breaker.allow(0))
+        breaker.succeeded()
+        self.failUnless(breaker.allow(60))
+        self.failUnless(breaker.allow(60))
+
+    def testCancelledProbe(self):
+        breaker = plugin.CircuitBreaker()
+        breaker.failed(1)
+        self.failUnless(breaker.allow(0))
+        breaker.cancel()
+        self.failUnless(breaker.allow(0))
+
+class RequestTestCase(PluginTestCase):
+    plugins = ('Weather',)
+    def testOpenBreakerSkipsLimiter(self):
+        calls = []
+        class Pool(object):
+            def request(self, *args):
+                calls.append('request')
+        def getLimiter(host):
+            calls.append('limiter')
+        pool = plugin.Weather._pool
+        orig = plugin.Weather.__dict__['_getLimiter']
+        breaker = plugin.Weather._breakers['ham']
+        threshold = conf.supybot.plugins.Weather.breaker.threshold()
+        plugin.Weather._pool = Pool()
+        plugin.Weather._getLimiter = staticmethod(getLimiter)
+        try:
+            for _ in range(threshold):
+                breaker.failed(threshold)
+            started = time.time()
+            self.assertRaises(plugin.ProviderUnavailable,
+                              plugin.Weather._request, 'ham',
+                              'http://www.hamweather.net/')
+            self.failUnless(time.time() - started < 0.1)
+        finally:
+            breaker.succeeded()
+            plugin.Weather._pool = pool
+            plugin.Weather._getLimiter = orig
+        self.assertEqual(calls, [])
+
+class HostLimiterTestCase(SupyTestCase):
+    def testConcurrency(self):
+        limiter = plugin.HostLimiter()
+        self.failUnless(limiter.acquire(0, 1, 1, 0))
+        self.failIf(limiter.acquire(0, 1, 1, 0.1))
+        limiter.release()
+        self.failUnless(limiter.acquire(0, 1, 1, 0))
+
+    def testRate(self):
+        limiter = plugin.HostLimiter()
+        self.failUnless(limiter.acquire(10, 1, 0, 0))
+        limiter.release()
+        self.failIf(limiter.acquire(10, 1, 0, 0))
+        self.failUnless(limiter.acquire(10, 1, 0, 0.5))
+
+    def testNegativeRate(self):
+        limiter = plugin.HostLimiter()
+        for _ in range(3):
+            self.failUnless(limiter.acquire(-1, 1, 0, 0))
+            limiter.release()
+
+class MetricsTestCase(PluginTestCase):
+    plugins = ('Weather',)
+    config = {'supybot.plugins.Weather.metrics.file': 'Weather.prom'}
+    sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)'
+                        r'(?:\{((?:[a-zA-Z_]\w*="(?:[^"\\\n]|\\.)*",?)*)\})? '
+                        r'(\S+)$')
+    def parse(self, text):
+        """Checks text is in the Prometheus text format and returns its
+        samples as {(name, labels): value}."""
+        self.failUnless(text.endswith('\n'))
+        types = {}
+        samples = {}
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                (name, kind) = line.split()[2:]
+                self.failIf(name in types)
+                types[name] = kind
+                continue
+            if line.startswith('#'):
+                continue
+            m = self.sample.match(line)
+            self.failUnless(m, 'Invalid sample: %r' % line)
+            (name, labels, value) = m.groups()
+            family = re.sub(r'_(bucket|sum|count)$', '', name)
+            self.failUnless(name in types or types.get(family) == 'histogram',
+                            'Untyped sample: %r' % line)
+            labels = tuple(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"',
+                                      labels or ''))
+            self.failIf((name, labels) in samples)
+            samples[(name, labels)] = float(value)
+        return samples
+
+    def testExposition(self):
+        stats = plugin.ProviderStats()
+        stats.measure('ham', lambda: None)
+        stats.count('ham', 'bytes', 100)
+        histograms = plugin.Histograms()
+        timing = plugin.Timing('ham', 'Columbus')
+        timing.seconds['fetch'] = 0.2
+        timing.total = 0.3
+        histograms(timing)
+        histograms(timing)
+        samples = self.parse(plugin.exposition(('ham', 'cnn'), stats,
+                                               histograms))
+        name = 'supybot_weather_'
+        self.assertEqual(samples[(name + 'requests_total',
+                                  (('command', 'ham'),))], 1)
+        self.assertEqual(samples[(name + 'results_total',
+                                  (('command', 'cnn'),
+                                   ('result', 'found')))], 0)
+        self.assertEqual(samples[(name + 'fetched_bytes_total',
+                                  (('command', 'ham'),))], 100)
+        labels = (('command', 'ham'), ('le', '0.1'), ('stage', 'fetch'))
+        self.assertEqual(samples[(name + 'seconds_bucket', labels)], 0)
+        labels = (('command', 'ham'), ('le', '0.25'), ('stage', 'fetch'))
+        self.assertEqual(samples[(name + 'seconds_bucket', labels)], 2)
+        labels = (('command', 'ham'), ('le', '+Inf'), ('stage', 'fetch'))
+        self.assertEqual(samples[(name + 'seconds_bucket', labels)], 2)
+        labels = (('command', 'ham'), ('stage', 'fetch'))
+        self.assertEqual(samples[(name + 'seconds_count', labels)], 2)
+        self.assertAlmostEqual(samples[(name + 'seconds_sum', labels)], 0.4)
+
+    def testScrape(self):
+        cb = self.irc.getCallback('Weather')
+        server = plugin.MetricsServer(0, cb._exposition)
+        server.start()
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', server.server_port)
+            conn.request('GET', '/metrics')
+            response = conn.getresponse()
+            self.assertEqual(response.status, 200)
+            self.failUnless(response.getheader('content-type')
+                            .startswith('text/plain'))
+            samples = self.parse(response.read())
+            conn.close()
+        finally:
+            server.stop()
+        for command in plugin.Weather.weatherCommands:
+            self.failUnless(('supybot_weather_requests_total',
+                             (('command', command),)) in samples)
+
+    def testFile(self):
+        self.irc.getCallback('Weather')._writeMetrics()
+        filename = conf.supybot.directories.data.dirize('Weather.prom')
+        fd = open(filename)
+        try:
+            self.parse(fd.read())
+        finally:
+            fd.close()
+
+class ProviderStatsTestCase(SupyTestCase):
+    def testMeasure(self):
+        stats = plugin.ProviderStats(window=20)
+        def lookup(seconds):
+            if seconds is None:
+                raise utils.web.Error, 'Connection refused.'
+            return seconds
+        for i in range(40):
+            stats.measure('ham', lookup, 0)
+        self.assertRaises(utils.web.Error, stats.measure, 'ham', lookup, None)
+        stats.count('ham', 'bytes', 512)
+        d = stats.get('ham')
+        self.assertEqual((d['requests'], d['success'], d['webError'],
+                          d['bytes']), (41, 40, 1, 512))
+        self.failUnless(d['p95'] < 0.01)
+        stats.reset()
+        self.assertEqual(stats.get('ham')['requests'], 0)
+
+class TimingsTestCase(SupyTestCase):
+    def testStagesExcludeNestedStages(self):
+        timed = []
+        timings = plugin.Timings([timed.append])
+        def fetch():
+            time.sleep(0.1)
+            return 'page'
+        def parse():
+            return timings.time('fetch', fetch).upper()
+        timing = timings.start('ham', 'Columbus')
+        self.assertEqual(timings.time('parse', parse), 'PAGE')
+        timings.finish(timing, True)
+        self.assertEqual(timed, [timing])
+        self.failUnless(timing.seconds['fetch'] >= 0.1)
+        self.failUnless(timing.seconds['parse'] < 0.05)
+        self.failUnless(timing.total >= 0.1)
+        self.assertEqual(timings.current(), None)
+        # Outside of a command, nothing is timed.
+        self.assertEqual(timings.time('parse', parse), 'PAGE')
+
+    def testHistograms(self):
+        histograms = plugin.Histograms()
+        timing = plugin.Timing('ham', 'Columbus')
+        timing.seconds['fetch'] = 0.3
+        timing.total = 20
+        histograms(timing)
+        histograms(timing)
+        (counts, seconds) = histograms.get('ham', 'fetch')
+        self.assertEqual(counts[list(histograms.buckets).index(0.5)], 2)
+        self.assertAlmostEqual(seconds, 0.6)
+        self.assertEqual(histograms.get('ham', 'total')[0][-1], 2)
+        histograms.clear()
+        self.assertEqual(sum(histograms.get('ham', 'fetch')[0]), 0)
+
+class SingleFlightTestCase(SupyTestCase):
+    def testConcurrentCallsAreCoalesced(self):
+        flights = plugin.SingleFlight()
+        calls = []
+        results = []
+        def lookup(loc):
+            calls.append(loc)
+            time.sleep(0.2)
+            return loc.upper()
+        def run():
+            results.append(flights.do(('ham', 'columbus, oh'), lookup,
+                                      'columbus, oh'))
+        threads = [threading.Thread(target=run) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(calls, ['columbus, oh'])
+        self.assertEqual(results, ['COLUMBUS, OH'] * 5)
+
+    def testExceptionsPropagate(self):
+        flights = plugin.SingleFlight()
+        def lookup():
+            raise plugin.NoLocation
+        self.assertRaises(plugin.NoLocation, flights.do, 'key', lookup)
+        self.assertEqual(flights.calls, {})
+
+def readFixture(name):
+    filename = os.path.join(os.path.dirname(plugin.__file__), 'fixtures', name)
+    fd = open(filename, 'rb')
+    try:
+        return fd.read()
+    finally:
+        fd.close()
+
+class DecodeTestCase(SupyTestCase):
+    page = readFixture('ham-columbus.html')
+
+    def testGzip(self):
+        sio = StringIO()
+        fd = gzip.GzipFile(fileobj=sio, mode='wb')
+        fd.write(self.page)
+        fd.close()
+        self.assertEqual(plugin.decode(sio.getvalue(), 'gzip'), self.page)
+
+    def testDeflate(self):
+        self.assertEqual(plugin.decode(zlib.compress(self.page), 'deflate'),
+                         self.page)
+        raw = zlib.compress(self.page)[2:-4]
+        self.assertEqual(plugin.decode(raw, 'Deflate'), self.page)
+
+    def testIdentity(self):
+        self.assertEqual(plugin.decode(self.page, None), self.page)
+        self.assertEqual(plugin.decode('', 'gzip'), '')
+
+    def testErrors(self):
+        self.assertRaises(utils.web.Error, plugin.decode, self.page, 'gzip')
+        self.assertRaises(utils.web.Error, plugin.decode, self.page, 'br')
+
+    def testDecoderTakesPieces(self):
+        sio = StringIO()
+        fd = gzip.GzipFile(fileobj=sio, mode='wb')
+        fd.write(self.page)
+        fd.close()
+        body = sio.getvalue()
+        decoder = plugin.Decoder('gzip')
+        pieces = [decoder.decode(body[i:i+100])
+                  for i in range(0, len(body), 100)]
+        self.assertEqual(''.join(pieces) + decoder.flush(), self.page)
+
+class ScannerTestCase(SupyTestCase):
+    page = readFixture('ham-columbus.html')
+    def feed(self, scanner, text):
+        for i in range(0, len(text), 1024):
+            if scanner.feed(text[i:i+1024]):
+                break
+        return scanner.text
+
+    def testStopsOnceFieldsMatch(self):
+        cb = plugin.Weather
+        text = self.feed(plugin.Scanner(cb._hamFields, 65536), self.page)
+        self.failUnless(len(text) < len(self.page))
+        for r in (cb._hamLoc, cb._hamCond, cb._hamTemp, cb._hamChill):
+            self.assertEqual(r.search(text).groups(),
+                             r.search(self.page).groups())
+
+    def testOnlyWholeLinesMatch(self):
+        scanner = plugin.Scanner([re.compile('foo.*')], 100)
+        self.failIf(scanner.feed('foo'))
+        self.failUnless(scanner.feed('bar\n'))
+
+    def testBudget(self):
+        scanner = plugin.Scanner([re.compile('nowhere')], 2048)
+        self.assertEqual(len(self.feed(scanner, self.page)), 2048)
+
+class FieldScannerTestCase(SupyTestCase):
+    def testMatchesSeparateSearches(self):
+        cb = plugin.Weather
+        html = readFixture('ham-columbus.html')
+        fields = cb._hamScanner.scan(html)
+        for (name, r) in (('loc', cb._hamLoc), ('temp', cb._hamTemp),
+                          ('cond', cb._hamCond), ('chill', cb._hamChill)):
+            self.assertEqual(fields[name].groups(), r.search(html).groups())
+        for name in ('notFound', 'multiple', 'multiLoc', 'heat'):
+            self.failIf(name in fields)
+
+    def testOverlappingPrefixes(self):
+        scanner = plugin.FieldScanner((('a', re.compile('abc')),
+                                       ('b', re.compile('bcd', re.I)),
+                                       ('c', 'CD'),
+                                       ('d', re.compile('xy?z'))))
+        self.assertEqual(sorted(scanner.scan('aBCD xz').keys()),
+                         ['b', 'c', 'd'])
+        self.assertRaises(ValueError, plugin.FieldScanner,
+                          [('e', re.compile(r'\s+'))])
+
+class WunderTableTestCase(SupyTestCase):
+    page = readFixture('wunder-mobile-columbus.html')
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.cb = plugin.Weather.wunder()
+
+    def parse(self, text):
+        text = self.cb._formatSymbols(text)
+        return (self.cb._wunderTable(text), self.cb._wunderSoup(text))
+
+    def testMatchesBeautifulSoup(self):
+        (table, soup) = self.parse(self.page)
+        self.assertEqual(table, soup)
+        self.assertEqual(table[1], 'Columbus, Ohio')
+        self.assertEqual(table[2]['Wind'], 'NW 10 mph')
+        self.assertEqual(table[2]['Temperature'], '45 \xb0 F 7 \xb0 C')
+        spaced = self.page.replace('<td><b>65%</b></td>',
+                                   '<td>\n  <b>65%</b>\n</td>')
+        (table, soup) = self.parse(spaced)
+        self.assertEqual(table, soup)
+
+    def testFallsBackOnOtherMarkup(self):
+        for (old, new) in (('<b>65%</b>', '<b>65%</b><br>'),
+                           ('<b>65%</b></td></tr>', '<b>65%</b></td>'),
+                           ('<td>Humidity</td>', '<td><i>Humidity</i></td>')):
+            text = self.cb._formatSymbols(self.page.replace(old, new))
+            self.assertEqual(self.cb._wunderTable(text), None)
+
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79: